@@ -1,7 +1,9 @@
 """Rotating coil analysis package."""
 
+from . import database
 from . import magnet_coil
 from . import measurement_data
+from . import migratedatabase
 from . import multipole_errors_spec
 from . import pdf_report
 from . import mplwidget
@@ -0,0 +1,556 @@
+"""Measurements database connections, array storage and schema updates."""
+
+import os as _os
+import contextlib as _contextlib
+import zlib as _zlib
+import struct as _struct
+import pathlib as _pathlib
+import sqlite3 as _sqlite3
+import threading as _threading
+import numpy as _np
+
+
+_mmap_size = 256*1024**2
+_cache_size_kib = 64*1024
+_cached_statements = 256
+
+_array_magic = b'RCA1'
+_array_header = '<4s3sBB'
+_array_dtypes = {
+    _np.dtype('float64'): b'<f8',
+    _np.dtype('float32'): b'<f4',
+    }
+
+_indexed_columns = [
+    'id', 'name', 'magnet_name', 'date', 'main_coil_current_avg']
+
+_text_index_suffix = '_fts'
+_text_index_excluded_columns = ['read_data', 'raw_curve']
+
+_chunk_size = 500
+_binary_columns = ['multipoles_bin', 'curves_bin']
+
+_derived_results_table = 'derived_results'
+_derived_results_version = 1
+_derived_results_n_harmonics = 15
+_derived_results_columns = [
+    ('main_harmonic', 'INTEGER'),
+    ('skew_magnet', 'INTEGER'),
+    ('main_multipole', 'REAL'),
+    ('main_multipole_err', 'REAL'),
+    ('roll', 'REAL'),
+    ('roll_err', 'REAL'),
+    ('magnetic_center_x', 'REAL'),
+    ('magnetic_center_x_err', 'REAL'),
+    ('magnetic_center_y', 'REAL'),
+    ('magnetic_center_y_err', 'REAL'),
+    ('normalization_radius', 'REAL'),
+    ] + [
+    ('{0:s}_{1:d}'.format(name, n), 'REAL')
+    for n in range(1, _derived_results_n_harmonics + 1)
+    for name in ('normal', 'skew')]
+
+_connections = {}
+_lock = _threading.Lock()
+
+
+def get_connection(database):
+    """Get the shared read-only connection to a database file.
+
+    One connection is kept for each database file, process and thread, so
+    the same connection can be reused by the GUI and the data layer.
+
+    Args:
+        database (str): database file path.
+
+    Returns:
+        sqlite3.Connection opened in read-only mode.
+    """
+    path = _os.path.abspath(database)
+    if not _os.path.isfile(path):
+        raise IOError('File not found: %s' % database)
+
+    key = (path, _os.getpid(), _threading.get_ident())
+    with _lock:
+        conn = _connections.get(key)
+        if conn is None:
+            conn = _connect(path)
+            _connections[key] = conn
+    return conn
+
+
+def close_connections(database=None, current_thread=False):
+    """Close the shared connections of this process.
+
+    Args:
+        database (str): database file path. If None, the connections to
+            all databases are closed.
+        current_thread (bool): close only the connections of the calling
+            thread.
+    """
+    path = _os.path.abspath(database) if database is not None else None
+    pid = _os.getpid()
+    ident = _threading.get_ident()
+    with _lock:
+        for key in list(_connections):
+            if (key[1] == pid and (path is None or key[0] == path)
+               and (not current_thread or key[2] == ident)):
+                _connections.pop(key).close()
+
+
+def create_indexes(database, columns=None):
+    """Create the indexes used to browse and filter the database tables.
+
+    The indexes are created on the columns of each table that exist and are
+    not indexed yet. Read-only databases are left unchanged.
+
+    Args:
+        database (str): database file path.
+        columns (list): column names to index. Defaults to id, name,
+            magnet_name, date and main_coil_current_avg.
+
+    Returns:
+        True if the indexes exist, False if they could not be created.
+    """
+    if columns is None:
+        columns = _indexed_columns
+
+    path = _os.path.abspath(database)
+    if not _os.path.isfile(path):
+        raise IOError('File not found: %s' % database)
+
+    try:
+        conn = _sqlite3.connect(path, timeout=1)
+    except _sqlite3.Error:
+        return False
+
+    try:
+        cur = conn.cursor()
+        for table_name in get_table_names(cur):
+            cur.execute('PRAGMA TABLE_INFO("{0:s}")'.format(table_name))
+            table_info = cur.fetchall()
+            for ti in table_info:
+                column_name, column_type, pk = ti[1], ti[2], ti[5]
+                if column_name not in columns:
+                    continue
+                if pk == 1 and column_type.upper() == 'INTEGER':
+                    continue
+                cur.execute(
+                    'CREATE INDEX IF NOT EXISTS "{0:s}_{1:s}_idx" '
+                    'ON "{0:s}" ("{1:s}")'.format(table_name, column_name))
+        conn.commit()
+        return True
+    except _sqlite3.Error:
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+
+def create_text_index(database, table_name='measurements', columns=None):
+    """Create a full-text index over the text columns of a table.
+
+    The index is a FTS5 table named <table_name>_fts with the trigram
+    tokenizer, so it answers substring searches of three or more
+    characters. Triggers keep it in sync with the table, which means that
+    programs writing to the database need a SQLite build with FTS5.
+
+    Args:
+        database (str): database file path.
+        table_name (str): indexed table name. The table must have an
+            INTEGER PRIMARY KEY id column.
+        columns (list): indexed column names. Defaults to all TEXT columns
+            except read_data and raw_curve.
+
+    Returns:
+        True if the index was created, False if it already exists.
+    """
+    path = _os.path.abspath(database)
+    if not _os.path.isfile(path):
+        raise IOError('File not found: %s' % database)
+
+    index_name = table_name + _text_index_suffix
+    with _contextlib.closing(_sqlite3.connect(path)) as conn:
+        cur = conn.cursor()
+        if get_text_index(cur, table_name) is not None:
+            return False
+
+        if columns is None:
+            cur.execute('PRAGMA TABLE_INFO("{0:s}")'.format(table_name))
+            columns = [
+                ti[1] for ti in cur.fetchall()
+                if ti[2].upper() == 'TEXT'
+                and ti[1] not in _text_index_excluded_columns]
+        if len(columns) == 0:
+            raise ValueError('No text columns to index.')
+
+        names = ', '.join('"{0:s}"'.format(c) for c in columns)
+        new_values = ', '.join('new."{0:s}"'.format(c) for c in columns)
+        old_values = ', '.join('old."{0:s}"'.format(c) for c in columns)
+        fmt = {
+            'table': table_name, 'index': index_name, 'names': names,
+            'new': new_values, 'old': old_values}
+
+        cur.execute(
+            'CREATE VIRTUAL TABLE "{index}" USING fts5({names}, '
+            'content=\'{table}\', content_rowid=\'id\', '
+            'tokenize=\'trigram\')'.format(**fmt))
+        cur.execute(
+            'CREATE TRIGGER "{index}_ai" AFTER INSERT ON "{table}" BEGIN '
+            'INSERT INTO "{index}" (rowid, {names}) VALUES (new.id, {new}); '
+            'END'.format(**fmt))
+        cur.execute(
+            'CREATE TRIGGER "{index}_ad" AFTER DELETE ON "{table}" BEGIN '
+            'INSERT INTO "{index}" ("{index}", rowid, {names}) '
+            'VALUES (\'delete\', old.id, {old}); END'.format(**fmt))
+        cur.execute(
+            'CREATE TRIGGER "{index}_au" AFTER UPDATE OF {names} '
+            'ON "{table}" BEGIN '
+            'INSERT INTO "{index}" ("{index}", rowid, {names}) '
+            'VALUES (\'delete\', old.id, {old}); '
+            'INSERT INTO "{index}" (rowid, {names}) VALUES (new.id, {new}); '
+            'END'.format(**fmt))
+        cur.execute(
+            'INSERT INTO "{index}" ("{index}") VALUES (\'rebuild\')'.format(
+                **fmt))
+        conn.commit()
+    return True
+
+
+def get_text_index(cur, table_name):
+    """Get the full-text index of a table.
+
+    Args:
+        cur (sqlite3.Cursor): database cursor.
+        table_name (str): table name.
+
+    Returns:
+        tuple (index table name, list of indexed columns), or None if the
+            table has no full-text index.
+    """
+    index_name = table_name + _text_index_suffix
+    cur.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name = ?",
+        (index_name, ))
+    if cur.fetchone() is None:
+        return None
+
+    cur.execute('PRAGMA TABLE_INFO("{0:s}")'.format(index_name))
+    return index_name, [ti[1] for ti in cur.fetchall()]
+
+
+def get_table_names(cur):
+    """Get the data table names of a database.
+
+    SQLite internal tables, virtual tables and their shadow tables are not
+    included.
+
+    Args:
+        cur (sqlite3.Cursor): database cursor.
+
+    Returns:
+        list of table names.
+    """
+    cur.execute("SELECT name, sql FROM sqlite_master WHERE type='table'")
+    tables = cur.fetchall()
+    virtual_tables = [
+        name for name, sql in tables
+        if sql is not None and sql.upper().startswith('CREATE VIRTUAL')]
+    return [
+        name for name, sql in tables
+        if not name.startswith('sqlite_')
+        and name not in virtual_tables
+        and not any(name.startswith(v + '_') for v in virtual_tables)]
+
+
+def _connect(path):
+    uri = _pathlib.Path(path).as_uri() + '?mode=ro'
+    conn = _sqlite3.connect(
+        uri, uri=True, check_same_thread=False,
+        cached_statements=_cached_statements)
+    conn.execute('PRAGMA query_only = ON')
+    conn.execute('PRAGMA mmap_size = {0:d}'.format(_mmap_size))
+    conn.execute('PRAGMA cache_size = -{0:d}'.format(_cache_size_kib))
+    return conn
+
+
+def encode_array(array, dtype=_np.float64, compress=False):
+    """Pack an array as a little-endian binary blob with a shape header.
+
+    Args:
+        array (array): array to pack.
+        dtype (dtype): storage type, float64 or float32.
+        compress (bool): compress the array data with zlib.
+
+    Returns:
+        bytes.
+    """
+    dtype = _np.dtype(dtype)
+    if dtype not in _array_dtypes:
+        raise ValueError('Invalid array storage type: %s' % dtype)
+
+    code = _array_dtypes[dtype]
+    array = _np.ascontiguousarray(array, dtype=_np.dtype(code.decode()))
+    data = array.tobytes()
+    if compress:
+        data = _zlib.compress(data)
+
+    header = _struct.pack(
+        _array_header, _array_magic, code, int(compress), array.ndim)
+    shape = _struct.pack('<%dq' % array.ndim, *array.shape)
+    return header + shape + data
+
+
+def decode_array(blob):
+    """Unpack an array packed with encode_array.
+
+    Returns:
+        array in native byte order with the stored shape and type.
+    """
+    blob = bytes(blob)
+    size = _struct.calcsize(_array_header)
+    magic, code, compressed, ndim = _struct.unpack(
+        _array_header, blob[:size])
+    if magic != _array_magic:
+        raise ValueError('Invalid array blob.')
+
+    shape = _struct.unpack('<%dq' % ndim, blob[size:size + 8*ndim])
+    data = blob[size + 8*ndim:]
+    if compressed:
+        data = _zlib.decompress(data)
+
+    dtype = _np.dtype(code.decode())
+    array = _np.frombuffer(data, dtype=dtype).reshape(shape)
+    return array.astype(dtype.newbyteorder('='))
+
+
+def migrate_database(database, dtype=_np.float64, compress=True,
+                     chunk_size=_chunk_size):
+    """Backfill the binary array columns of a measurements database.
+
+    The multipoles_bin and curves_bin columns are created if needed and
+    filled from the read_data and raw_curve text of the rows that were not
+    converted yet. Rows that cannot be decoded keep the text only.
+
+    The text columns are kept, but the database browser of older versions
+    cannot display the binary columns, so a migrated database must be
+    opened with this version of the graphical interface.
+
+    Args:
+        database (str): database file path.
+        dtype (dtype): storage type of the raw curves, float64 or float32.
+            The multipoles are always stored in float64.
+        compress (bool): compress the arrays with zlib.
+        chunk_size (int): number of rows converted in each transaction.
+
+    Returns:
+        tuple (number of converted rows, list of the IDs of the rows
+            that could not be converted).
+    """
+    if not _os.path.isfile(database):
+        raise IOError('File not found: %s' % database)
+
+    converted = 0
+    failed = []
+    with _contextlib.closing(_sqlite3.connect(database)) as conn:
+        cur = conn.cursor()
+        cur.execute('PRAGMA TABLE_INFO(measurements)')
+        column_names = [ti[1] for ti in cur.fetchall()]
+        for name in _binary_columns:
+            if name not in column_names:
+                cur.execute(
+                    'ALTER TABLE measurements ADD COLUMN "{0:s}" BLOB'.format(
+                        name))
+        conn.commit()
+
+        last_idn = None
+        while True:
+            cur.execute(
+                'SELECT id, read_data, raw_curve FROM measurements '
+                'WHERE curves_bin IS NULL AND (? IS NULL OR id > ?) '
+                'ORDER BY id LIMIT ?', (last_idn, last_idn, chunk_size))
+            rows = cur.fetchall()
+            if len(rows) == 0:
+                break
+
+            updates = []
+            for idn, read_data, raw_curve in rows:
+                try:
+                    updates.append(
+                        _encode_database_row(
+                            read_data, raw_curve, dtype, compress) + (idn, ))
+                except Exception:
+                    failed.append(idn)
+
+            cur.executemany(
+                'UPDATE measurements SET multipoles_bin = ?, curves_bin = ? '
+                'WHERE id = ?', updates)
+            conn.commit()
+            converted += len(updates)
+            last_idn = rows[-1][0]
+
+    return converted, failed
+
+
+def update_derived_results(database, create=True,
+                           chunk_size=_chunk_size, stop=None):
+    """Update the derived results table of a measurements database.
+
+    The derived_results table stores, for each measurement ID, the main
+    multipole, roll, magnetic center and the multipoles normalized by the
+    main multipole at the normalization radius. Rows missing from the table
+    or written by an older version of the derived results are recomputed.
+
+    Args:
+        database (str): database file path.
+        create (bool): create the table if it does not exist. If False and
+            the table does not exist, nothing is done.
+        chunk_size (int): number of rows updated in each transaction.
+        stop (callable): called before each chunk. If it returns True, the
+            update stops and the remaining rows are left for the next one.
+
+    Returns:
+        tuple (number of updated rows, list of the IDs of the measurements
+            that could not be read; their derived values are left NULL).
+    """
+    if not _os.path.isfile(database):
+        raise IOError('File not found: %s' % database)
+
+    updated = 0
+    failed = []
+    with _contextlib.closing(_sqlite3.connect(database)) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name = ?",
+            (_derived_results_table, ))
+        if cur.fetchone() is None:
+            if not create:
+                return updated, failed
+            _create_derived_results_table(cur)
+            conn.commit()
+
+        cur.execute(
+            'SELECT m.id FROM measurements m LEFT JOIN {0:s} d '
+            'ON d.id = m.id WHERE d.id IS NULL OR d.version != ? '
+            'ORDER BY m.id'.format(_derived_results_table),
+            (_derived_results_version, ))
+        idns = [r[0] for r in cur.fetchall()]
+
+        column_names = [c[0] for c in _derived_results_columns]
+        cmd = 'INSERT OR REPLACE INTO {0:s} (id, version, {1:s}) '.format(
+            _derived_results_table, ', '.join(column_names))
+        cmd = cmd + 'VALUES ({0:s})'.format(
+            ', '.join(['?']*(len(column_names) + 2)))
+
+        for i in range(0, len(idns), chunk_size):
+            if stop is not None and stop():
+                break
+            chunk = idns[i:i + chunk_size]
+            rows = []
+            for idn, md in zip(chunk, _read_derived_results_chunk(
+                    database, chunk)):
+                if md is None:
+                    failed.append(idn)
+                    values = [None]*len(column_names)
+                else:
+                    values = _get_derived_results_values(md)
+                rows.append([idn, _derived_results_version] + values)
+            cur.executemany(cmd, rows)
+            conn.commit()
+            updated += len(rows)
+
+    return updated, failed
+
+
+def _create_derived_results_table(cur):
+    """Create the derived results table and its indexes."""
+    columns_str = ', '.join(
+        '{0:s} {1:s}'.format(name, vtype)
+        for name, vtype in _derived_results_columns)
+    cur.execute(
+        'CREATE TABLE {0:s} (id INTEGER PRIMARY KEY, version INTEGER, '
+        '{1:s})'.format(_derived_results_table, columns_str))
+    for name in ('main_harmonic', 'roll'):
+        cur.execute(
+            'CREATE INDEX IF NOT EXISTS {0:s}_{1:s}_idx '
+            'ON {0:s} ({1:s})'.format(_derived_results_table, name))
+
+
+def _read_derived_results_chunk(database, idns):
+    """Read the measurements of a chunk, with None for unreadable rows."""
+    from . import measurement_data as _measurement_data
+
+    try:
+        return _measurement_data.MeasurementData.from_database(
+            database, idns, read_curves=False)
+    except Exception:
+        pass
+
+    data = []
+    for idn in idns:
+        try:
+            data.append(_measurement_data.MeasurementData(
+                idn=idn, database=database, read_curves=False))
+        except Exception:
+            data.append(None)
+    return data
+
+
+def _get_derived_results_values(md):
+    """Get the derived results values of a measurement."""
+    values = dict.fromkeys(c[0] for c in _derived_results_columns)
+    multipoles = md.multipoles
+    main_harmonic = md.main_harmonic
+    if multipoles is None or main_harmonic is None:
+        return list(values.values())
+
+    n = int(main_harmonic) - 1
+    if md.skew_magnet:
+        main_multipole = multipoles[n, 3]
+        main_multipole_err = multipoles[n, 4]
+    else:
+        main_multipole = multipoles[n, 1]
+        main_multipole_err = multipoles[n, 2]
+
+    values.update({
+        'main_harmonic': int(main_harmonic),
+        'skew_magnet': int(bool(md.skew_magnet)),
+        'main_multipole': main_multipole,
+        'main_multipole_err': main_multipole_err,
+        'roll': md.roll,
+        'roll_err': md.roll_err,
+        'magnetic_center_x': md.magnetic_center_x,
+        'magnetic_center_x_err': md.magnetic_center_x_err,
+        'magnetic_center_y': md.magnetic_center_y,
+        'magnetic_center_y_err': md.magnetic_center_y_err,
+        'normalization_radius': md.normalization_radius,
+        })
+
+    r0 = md.normalization_radius
+    if r0 is not None and main_multipole != 0:
+        nr_harmonics = min(multipoles.shape[0], _derived_results_n_harmonics)
+        for m in range(nr_harmonics):
+            factor = (r0**(m - n))/main_multipole
+            values['normal_{0:d}'.format(m + 1)] = multipoles[m, 1]*factor
+            values['skew_{0:d}'.format(m + 1)] = multipoles[m, 3]*factor
+
+    return [
+        None if v is None else
+        int(v) if isinstance(v, (int, _np.integer)) else float(v)
+        for v in values.values()]
+
+
+def _encode_database_row(read_data, raw_curve, dtype, compress):
+    """Encode the multipoles and raw curves text of a database row."""
+    from . import measurement_data as _measurement_data
+
+    read_data_lines = [l for l in read_data.split('\n') if len(l) != 0]
+    multipoles = _np.array(
+        [l.split() for l in read_data_lines[1:]], dtype=_np.float64)
+
+    raw_curve_lines = [l for l in raw_curve.split('\n') if len(l) != 0]
+    curves = _measurement_data._decode_raw_curves(raw_curve_lines[2:], 1)
+
+    return (
+        encode_array(multipoles, compress=compress),
+        encode_array(curves, dtype=dtype, compress=compress))
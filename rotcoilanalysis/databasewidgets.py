@@ -1,27 +1,38 @@
 """Database tables widgets."""
 
+import re as _re
+import functools as _functools
+import contextlib as _contextlib
 import traceback
 import sys
 import os.path as _path
-import sqlite3 as _sqlite3
 import numpy as _np
-from PyQt5.QtCore import Qt as _Qt
+from PyQt5.QtCore import (
+    Qt as _Qt,
+    QThread as _QThread,
+    pyqtSignal as _pyqtSignal,
+    QModelIndex as _QModelIndex,
+    QAbstractTableModel as _QAbstractTableModel,
+    )
 from PyQt5.QtGui import QFont as _QFont
 from PyQt5.QtWidgets import (
     QWidget as _QWidget,
     QLabel as _QLabel,
     QTabWidget as _QTabWidget,
-    QTableWidget as _QTableWidget,
-    QTableWidgetItem as _QTableWidgetItem,
+    QTableView as _QTableView,
     QVBoxLayout as _QVBoxLayout,
     QHBoxLayout as _QHBoxLayout,
     QSpinBox as _QSpinBox,
+    QPushButton as _QPushButton,
     QAbstractItemView as _QAbstractItemView,
     )
 
+from . import database as _database
+
 _basepath = _path.dirname(_path.abspath(__file__))
 _fontsize = 15
-_max_number_rows = 1000
+_fetch_size = 1000
+_max_spin_box_value = 2**31 - 1
 _max_str_size = 1000
 
 
@@ -40,21 +51,22 @@ class DatabaseTab(_QTabWidget):
         self.clear()
         self.database_filename = None
         self.tables = []
+        self.loader = None
 
     def loadDatabase(self, database_filename):
+        """Load database.
+
+        The tabs are created at once and the table rows are read in a
+        background thread.
+        """
         try:
-            """Load database."""
             self.database_filename = database_filename
-            con = _sqlite3.connect(self.database_filename)
+            con = _database.get_connection(self.database_filename)
             cur = con.cursor()
-            res = cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
-
-            for r in res:
-                table_name = r[0]
-                if table_name != "sqlite_sequence" and (table_name !=
-                                                        'failures' and
-                                                        table_name !=
-                                                        'main'):
+            table_names = _database.get_table_names(cur)
+
+            for table_name in table_names:
+                if table_name != 'failures' and table_name != 'main':
                     table = DatabaseTable(self)
                     tab = _QWidget()
                     vlayout = _QVBoxLayout()
@@ -64,6 +76,12 @@ class DatabaseTab(_QTabWidget):
                     initial_id_sb = _QSpinBox()
                     initial_id_sb.setMinimumWidth(100)
                     initial_id_sb.setButtonSymbols(2)
+                    previous_page_btn = _QPushButton("Previous page")
+                    previous_page_btn.clicked.connect(table.previousPage)
+                    next_page_btn = _QPushButton("Next page")
+                    next_page_btn.clicked.connect(table.nextPage)
+                    hlayout.addWidget(previous_page_btn)
+                    hlayout.addWidget(next_page_btn)
                     hlayout.addStretch(0)
                     hlayout.addWidget(initial_id_la)
                     hlayout.addWidget(initial_id_sb)
@@ -78,7 +96,7 @@ class DatabaseTab(_QTabWidget):
                     hlayout.addWidget(number_rows_sb)
                     hlayout.addSpacing(30)
 
-                    max_number_rows_la = _QLabel("Maximum number of rows:")
+                    max_number_rows_la = _QLabel("Total number of rows:")
                     max_number_rows_sb = _QSpinBox()
                     max_number_rows_sb.setMinimumWidth(100)
                     max_number_rows_sb.setButtonSymbols(2)
@@ -91,7 +109,8 @@ class DatabaseTab(_QTabWidget):
                         table_name,
                         initial_id_sb,
                         number_rows_sb,
-                        max_number_rows_sb)
+                        max_number_rows_sb,
+                        background=True)
 
                     vlayout.addWidget(table)
                     vlayout.addLayout(hlayout)
@@ -99,6 +118,39 @@ class DatabaseTab(_QTabWidget):
 
                     self.tables.append(table)
                     self.addTab(tab, table_name)
+
+            self._startLoader([
+                (table.table_model.readRows, table.applyRows)
+                for table in self.tables])
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+
+    def refreshDatabase(self):
+        """Read the rows added to the database tables since the last read."""
+        if self.database_filename is None:
+            return
+
+        self._startLoader([
+            (table.table_model.readNewRows, table.applyNewRows)
+            for table in self.tables])
+
+    def _startLoader(self, jobs):
+        self._stopLoader()
+        jobs = jobs + [(_functools.partial(
+            _update_database, self.database_filename), None)]
+        self.loader = DatabaseLoader(self.database_filename, jobs)
+        self.loader.resultReady.connect(self._applyResult)
+        self.loader.start()
+
+    def _stopLoader(self):
+        if self.loader is not None:
+            self.loader.requestInterruption()
+            self.loader.wait()
+            self.loader = None
+
+    def _applyResult(self, apply, result):
+        try:
+            apply(result)
         except Exception:
             traceback.print_exc(file=sys.stdout)
 
@@ -110,16 +162,434 @@ class DatabaseTab(_QTabWidget):
 
     def clearDatabase(self):
         """Clear database."""
+        self._stopLoader()
         ntabs = self.count()
         for idx in range(ntabs):
             self.removeTab(idx)
             self.tables[idx].deleteLater()
+        if self.database_filename is not None:
+            _database.close_connections(self.database_filename)
         self.database_filename = None
         self.tables = []
         self.clear()
 
 
-class DatabaseTable(_QTableWidget):
+class DatabaseLoader(_QThread):
+    """Thread that reads the database tables rows.
+
+    Each job is a pair of functions. The first one is called in the thread
+    and its result is sent back to the GUI thread, where it is passed to
+    the second one, unless it is None. The shared connections of the thread
+    are closed when the jobs end.
+    """
+
+    resultReady = _pyqtSignal(object, object)
+
+    def __init__(self, database, jobs, parent=None):
+        """Initialize the thread."""
+        super().__init__(parent)
+        self.database = database
+        self.jobs = jobs
+
+    def run(self):
+        """Run the jobs."""
+        try:
+            for read, apply in self.jobs:
+                if self.isInterruptionRequested():
+                    return
+                try:
+                    result = read()
+                except Exception:
+                    traceback.print_exc(file=sys.stdout)
+                    continue
+                if apply is not None:
+                    self.resultReady.emit(apply, result)
+        finally:
+            _database.close_connections(self.database, current_thread=True)
+
+
+class DatabaseTableModel(_QAbstractTableModel):
+    """Database table model with on demand row fetching.
+
+    The first row holds the column filters. The measurement rows are read
+    from the database in windows of _fetch_size rows and the cells are
+    formatted only when the view requests them. Newer rows are appended by
+    fetchMore and older rows are prepended by fetchPrevious.
+    """
+
+    def __init__(self, parent=None):
+        """Initialize the model."""
+        super().__init__(parent)
+        self.database = None
+        self.table_name = None
+        self.column_names = []
+        self.data_types = []
+        self.filters = []
+        self.text_index = None
+        self.rows = []
+        self.total_number_rows = 0
+        self.id_range = (None, None)
+        self._has_more = False
+        self._has_previous = False
+        self._generation = 0
+
+    def setTable(self, database, table_name, column_names, data_types):
+        """Set database table and columns."""
+        self.beginResetModel()
+        self.database = database
+        self.table_name = table_name
+        self.column_names = column_names
+        self.data_types = data_types
+        con = _database.get_connection(database)
+        with _contextlib.closing(con.cursor()) as cur:
+            self.text_index = _database.get_text_index(cur, table_name)
+        self.filters = [''] * len(column_names)
+        self.rows = []
+        self.total_number_rows = 0
+        self.id_range = (None, None)
+        self._has_more = False
+        self._has_previous = False
+        self._generation += 1
+        self.endResetModel()
+
+    def rowCount(self, parent=_QModelIndex()):
+        """Return the number of rows, including the filter row."""
+        if parent.isValid() or len(self.column_names) == 0:
+            return 0
+        return len(self.rows) + 1
+
+    def columnCount(self, parent=_QModelIndex()):
+        """Return the number of columns."""
+        if parent.isValid():
+            return 0
+        return len(self.column_names)
+
+    def headerData(self, section, orientation, role=_Qt.DisplayRole):
+        """Return the column names."""
+        if (role == _Qt.DisplayRole and orientation == _Qt.Horizontal
+           and section < len(self.column_names)):
+            return self.column_names[section]
+        return None
+
+    def data(self, index, role=_Qt.DisplayRole):
+        """Return the cell text."""
+        if not index.isValid() or role not in (_Qt.DisplayRole, _Qt.EditRole):
+            return None
+
+        row = index.row()
+        column = index.column()
+        if row == 0:
+            return self.filters[column]
+
+        item_str = str(self.rows[row - 1][column])
+        if len(item_str) > _max_str_size:
+            item_str = item_str[:10] + '...'
+        return item_str
+
+    def flags(self, index):
+        """Return the item flags. Only the filter row is editable."""
+        if not index.isValid():
+            return _Qt.NoItemFlags
+        flags = _Qt.ItemIsSelectable | _Qt.ItemIsEnabled
+        if index.row() == 0:
+            flags = flags | _Qt.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=_Qt.EditRole):
+        """Set a column filter."""
+        if not index.isValid() or index.row() != 0 or role != _Qt.EditRole:
+            return False
+
+        self.filters[index.column()] = str(value)
+        self._generation += 1
+        self.dataChanged.emit(index, index)
+        return True
+
+    def canFetchMore(self, parent=_QModelIndex()):
+        """Check if there are rows left to read."""
+        if parent.isValid():
+            return False
+        return self._has_more
+
+    def fetchMore(self, parent=_QModelIndex()):
+        """Read the next window of rows."""
+        if parent.isValid() or not self._has_more:
+            return
+
+        last_id = self.rows[-1][0] if len(self.rows) > 0 else None
+        rows, self._has_more = self._fetchRows(after_id=last_id)
+        if len(rows) == 0:
+            return
+
+        first = len(self.rows) + 1
+        self.beginInsertRows(_QModelIndex(), first, first + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+
+    def canFetchPrevious(self):
+        """Check if there are rows left to read before the first row."""
+        return self._has_previous
+
+    def fetchPrevious(self):
+        """Read the previous window of rows.
+
+        Returns:
+            number of rows inserted before the first row.
+        """
+        if not self._has_previous or len(self.rows) == 0:
+            return 0
+
+        rows, self._has_previous = self._fetchRows(before_id=self.rows[0][0])
+        if len(rows) == 0:
+            return 0
+
+        self.beginInsertRows(_QModelIndex(), 1, len(rows))
+        self.rows[0:0] = rows
+        self.endInsertRows()
+        return len(rows)
+
+    def getID(self, row):
+        """Get the ID of a table row."""
+        return self.rows[row - 1][0]
+
+    def getValue(self, row, column_name):
+        """Get the value of a table row column."""
+        return self.rows[row - 1][self.column_names.index(column_name)]
+
+    def select(self, initial_id=None):
+        """Count and read the rows matching the filters.
+
+        Args:
+            initial_id (int): first ID to show. If None, the last
+                _fetch_size rows are shown.
+        """
+        self.setRows(self.readRows(initial_id=initial_id))
+
+    def readRows(self, initial_id=None):
+        """Count and read the rows matching the filters.
+
+        The model is not changed, so this can run in a worker thread. The
+        result is shown with setRows.
+
+        Args:
+            initial_id (int): first ID to show. If None, the last
+                _fetch_size rows are shown.
+
+        Returns:
+            dict with the rows, the number of matching rows and the table
+                ID range.
+        """
+        result = {
+            'generation': self._generation,
+            'rows': [],
+            'has_more': False,
+            'has_previous': False,
+            'total_number_rows': 0,
+            'id_range': (None, None),
+            }
+        if self.table_name is None or len(self.column_names) == 0:
+            return result
+
+        result['id_range'] = self._readIDRange()
+        result['total_number_rows'] = self._countRows()
+        result.update(self._readPage(initial_id))
+        return result
+
+    def setRows(self, result):
+        """Show the rows read with readRows.
+
+        Returns:
+            False if the filters changed after the rows were read.
+        """
+        if result['generation'] != self._generation:
+            return False
+
+        self.total_number_rows = result['total_number_rows']
+        self.id_range = result['id_range']
+        self._setRows(
+            result['rows'], result['has_more'], result['has_previous'])
+        return True
+
+    def readNewRows(self):
+        """Read the rows added after the last loaded row.
+
+        If the last loaded row is not the last matching row, only the
+        number of rows and the ID range are read. The model is not changed,
+        so this can run in a worker thread. The result is shown with
+        addNewRows.
+
+        Returns:
+            dict with the new rows, the number of matching rows and the
+                table ID range.
+        """
+        if len(self.rows) == 0:
+            return self.readRows()
+
+        result = {
+            'generation': self._generation,
+            'rows': [],
+            'has_more': self._has_more,
+            'total_number_rows': self._countRows(),
+            'id_range': self._readIDRange(),
+            }
+        if not self._has_more:
+            result['rows'], result['has_more'] = self._fetchRows(
+                after_id=self.rows[-1][0])
+        return result
+
+    def addNewRows(self, result):
+        """Append the rows read with readNewRows.
+
+        Returns:
+            False if the filters changed after the rows were read.
+        """
+        if result['generation'] != self._generation:
+            return False
+
+        if len(self.rows) == 0:
+            return self.setRows(result)
+
+        self.total_number_rows = result['total_number_rows']
+        self.id_range = result['id_range']
+        self._has_more = result['has_more']
+        rows = [r for r in result['rows'] if r[0] > self.rows[-1][0]]
+        if len(rows) > 0:
+            first = len(self.rows) + 1
+            self.beginInsertRows(
+                _QModelIndex(), first, first + len(rows) - 1)
+            self.rows.extend(rows)
+            self.endInsertRows()
+        return True
+
+    def seek(self, initial_id=None):
+        """Show the page starting at an ID.
+
+        Args:
+            initial_id (int): first ID to show. If None, the last
+                _fetch_size rows are shown.
+        """
+        page = {'rows': [], 'has_more': False, 'has_previous': False}
+        if self.table_name is not None and len(self.column_names) > 0:
+            page = self._readPage(initial_id)
+        self._setRows(page['rows'], page['has_more'], page['has_previous'])
+
+    def nextPage(self):
+        """Show the rows after the last loaded row.
+
+        Returns:
+            True if the page changed.
+        """
+        if len(self.rows) == 0:
+            return False
+
+        rows, has_more = self._fetchRows(after_id=self.rows[-1][0])
+        if len(rows) == 0:
+            self._has_more = False
+            return False
+
+        self._setRows(rows, has_more, True)
+        return True
+
+    def previousPage(self):
+        """Show the rows before the first loaded row.
+
+        Returns:
+            True if the page changed.
+        """
+        if len(self.rows) == 0:
+            return False
+
+        rows, has_previous = self._fetchRows(before_id=self.rows[0][0])
+        if len(rows) == 0:
+            self._has_previous = False
+            return False
+
+        self._setRows(rows, True, has_previous)
+        return True
+
+    def _setRows(self, rows, has_more, has_previous):
+        self.beginResetModel()
+        self.rows = rows
+        self._has_more = has_more
+        self._has_previous = has_previous
+        self._generation += 1
+        self.endResetModel()
+
+    def _readPage(self, initial_id=None):
+        if initial_id is None:
+            rows, has_previous = self._fetchRows(last=True)
+            return {
+                'rows': rows, 'has_more': False,
+                'has_previous': has_previous}
+
+        rows, has_more = self._fetchRows(from_id=initial_id)
+        has_previous = False
+        if len(rows) > 0:
+            previous_rows, _ = self._fetchRows(before_id=rows[0][0], limit=1)
+            has_previous = len(previous_rows) > 0
+        return {
+            'rows': rows, 'has_more': has_more, 'has_previous': has_previous}
+
+    def _readIDRange(self):
+        cmd = 'SELECT MIN(id), MAX(id) FROM {0:s}'.format(self.table_name)
+        con = _database.get_connection(self.database)
+        return tuple(con.execute(cmd).fetchone())
+
+    def _getWhereClause(self):
+        return compile_filters(
+            self.column_names, self.data_types, self.filters,
+            text_index=self.text_index)
+
+    def _countRows(self):
+        conditions, params = self._getWhereClause()
+        cmd = 'SELECT COUNT(*) FROM {0:s}'.format(self.table_name)
+        if len(conditions) > 0:
+            cmd = cmd + ' WHERE ' + ' AND '.join(conditions)
+
+        con = _database.get_connection(self.database)
+        return con.execute(cmd, params).fetchone()[0]
+
+    def _fetchRows(
+            self, after_id=None, from_id=None, before_id=None, last=False,
+            limit=_fetch_size):
+        """Read a window of rows with a keyset query.
+
+        Returns:
+            tuple (rows in ID order, True if there are more matching rows
+                past the window, in the read direction).
+        """
+        conditions, params = self._getWhereClause()
+        if after_id is not None:
+            conditions.append('id > ?')
+            params.append(after_id)
+        if from_id is not None:
+            conditions.append('id >= ?')
+            params.append(from_id)
+        if before_id is not None:
+            conditions.append('id < ?')
+            params.append(before_id)
+            last = True
+
+        column_names_str = ', '.join(
+            '"{0:s}"'.format(col_name) for col_name in self.column_names)
+        cmd = 'SELECT {0:s} FROM {1:s}'.format(
+            column_names_str, self.table_name)
+        if len(conditions) > 0:
+            cmd = cmd + ' WHERE ' + ' AND '.join(conditions)
+        cmd = cmd + ' ORDER BY id {0:s} LIMIT ?'.format(
+            'DESC' if last else 'ASC')
+        params.append(limit + 1)
+
+        con = _database.get_connection(self.database)
+        rows = con.execute(cmd, params).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if last:
+            rows.reverse()
+        return rows, has_more
+
+
+class DatabaseTable(_QTableView):
     """Database table widget."""
 
     _datatype_dict = {
@@ -131,6 +601,8 @@ class DatabaseTable(_QTableWidget):
     _hidden_columns = [
         'read_data',
         'raw_curve',
+        'multipoles_bin',
+        'curves_bin',
         ]
 
     def __init__(self, parent=None):
@@ -142,25 +614,63 @@ class DatabaseTable(_QTableWidget):
         self.horizontalHeader().setStretchLastSection(True)
         self.horizontalHeader().setDefaultSectionSize(120)
 
+        self.table_model = DatabaseTableModel(self)
+        self.setModel(self.table_model)
+
         self.database = None
         self.table_name = None
         self.column_names = []
         self.data_types = []
-        self.data = []
         self.initial_table_id = None
         self.initial_id_sb = None
         self.number_rows_sb = None
         self.max_number_rows_sb = None
 
+        self.table_model.dataChanged.connect(self.filterChanged)
+        self.table_model.rowsInserted.connect(self.updateNumberRows)
+        self.selectionModel().selectionChanged.connect(self.selectLine)
+        self.verticalScrollBar().actionTriggered.connect(self.fetchPrevious)
+
     def changeInitialID(self):
-        """Change initial ID."""
+        """Jump to the page starting at the initial ID."""
         initial_id = self.initial_id_sb.value()
-        self.filterColumn(initial_id=initial_id)
+        if initial_id == self.initial_table_id:
+            return
+
+        try:
+            self.table_model.seek(initial_id=initial_id)
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+
+        self.updateNumberRows()
+
+    def nextPage(self):
+        """Show the next page of rows."""
+        try:
+            if self.table_model.nextPage():
+                self.updateNumberRows()
+                self.scrollToTop()
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+
+    def previousPage(self):
+        """Show the previous page of rows."""
+        try:
+            if self.table_model.previousPage():
+                self.updateNumberRows()
+                self.scrollDown()
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
 
     def loadDatabaseTable(
             self, database, table_name,
-            initial_id_sb, number_rows_sb, max_number_rows_sb):
-        """Set database filename and table name."""
+            initial_id_sb, number_rows_sb, max_number_rows_sb,
+            background=False):
+        """Set database filename and table name.
+
+        If background is True, the rows are not read. They must be read
+        with table_model.readRows and shown with applyRows.
+        """
         self.database = database
         self.table_name = table_name
 
@@ -168,30 +678,25 @@ class DatabaseTable(_QTableWidget):
         self.initial_id_sb.editingFinished.connect(self.changeInitialID)
 
         self.number_rows_sb = number_rows_sb
-        self.number_rows_sb.setMaximum(_max_number_rows)
+        self.number_rows_sb.setMaximum(_max_spin_box_value)
 
         self.max_number_rows_sb = max_number_rows_sb
-        self.max_number_rows_sb.setMaximum(_max_number_rows)
+        self.max_number_rows_sb.setMaximum(_max_spin_box_value)
 
-        self.updateTable()
+        self.updateTable(background=background)
 
-    def updateTable(self):
+    def updateTable(self, background=False):
         """Update table."""
         if self.database is None or self.table_name is None:
             return
-        
-        self.blockSignals(True)
-        self.clearContents()
-        self.setColumnCount(0)
-        self.setRowCount(0)
 
-        con = _sqlite3.connect(self.database)
+        con = _database.get_connection(self.database)
         cur = con.cursor()
 
         cmd = "PRAGMA TABLE_INFO({0})".format(self.table_name)
         cur.execute(cmd)
         table_info = cur.fetchall()
-        
+
         self.column_names = []
         self.data_types = []
         for ti in table_info:
@@ -200,192 +705,225 @@ class DatabaseTable(_QTableWidget):
             if column_name not in self._hidden_columns:
                 self.column_names.append(column_name)
                 self.data_types.append(self._datatype_dict[column_type])
-               
-        self.setColumnCount(len(self.column_names))
-        self.setHorizontalHeaderLabels(self.column_names)
-
-        self.setRowCount(1)
-        for j in range(len(self.column_names)):
-            self.setItem(0, j, _QTableWidgetItem(''))
-  
-        column_names_str = ''
-        for col_name in self.column_names:
-            column_names_str = column_names_str + '"{0:s}", '.format(col_name)
-        column_names_str = column_names_str[:-2]
-
-        cmd = 'SELECT * FROM (SELECT {0:s} FROM {1:s} ORDER BY id DESC LIMIT {2:d}) ORDER BY id ASC'.format(
-             column_names_str, self.table_name, _max_number_rows)
-        data = cur.execute(cmd).fetchall()
-
-        if len(data) > 0:
-            cmd = 'SELECT MIN(id) FROM {0}'.format(self.table_name)
-            min_idn = cur.execute(cmd).fetchone()[0]
-            self.initial_id_sb.setMinimum(min_idn)
 
-            cmd = 'SELECT MAX(id) FROM {0}'.format(self.table_name)
-            max_idn = cur.execute(cmd).fetchone()[0]               
-            self.initial_id_sb.setMaximum(max_idn)
-            
-            self.max_number_rows_sb.setValue(len(data))
-            self.data = data[:]
-            self.addRowsToTable(data)
-        else:
-            self.initial_id_sb.setMinimum(0)
-            self.initial_id_sb.setMaximum(0)
-            self.max_number_rows_sb.setValue(0)
-        
-        self.setSelectionBehavior(_QAbstractItemView.SelectRows)
-        self.blockSignals(False)
-        self.itemChanged.connect(self.filterChanged)
-        self.itemSelectionChanged.connect(self.selectLine)
+        self.table_model.setTable(
+            self.database, self.table_name,
+            self.column_names, self.data_types)
 
-    def addRowsToTable(self, data):
-        """Add rows to table."""
-        if len(self.column_names) == 0:
-            return
+        self.setSelectionBehavior(_QAbstractItemView.SelectRows)
+        if not background:
+            self.filterColumn()
 
-        self.setRowCount(1)
+    def applyRows(self, result):
+        """Show the rows read with table_model.readRows."""
+        if self.table_model.setRows(result):
+            self.updateNumberRows()
+            self.scrollDown()
 
-        if len(data) > self.max_number_rows_sb.value():
-            tabledata = data[-self.max_number_rows_sb.value()::]
+    def applyNewRows(self, result):
+        """Show the rows read with table_model.readNewRows."""
+        vbar = self.verticalScrollBar()
+        at_end = vbar.value() == vbar.maximum()
+        if self.table_model.addNewRows(result):
+            self.updateNumberRows()
+            if at_end:
+                self.scrollDown()
+
+    def updateNumberRows(self):
+        """Update the row number and ID spin boxes."""
+        min_idn, max_idn = self.table_model.id_range
+        if min_idn is not None:
+            self.initial_id_sb.setMinimum(min_idn)
+            self.initial_id_sb.setMaximum(max_idn)
         else:
-            tabledata = data
+            self.initial_id_sb.setMinimum(0)
+            self.initial_id_sb.setMaximum(0)
 
-        if len(tabledata) == 0:
+        rows = self.table_model.rows
+        self.number_rows_sb.setValue(len(rows))
+        self.max_number_rows_sb.setValue(self.table_model.total_number_rows)
+        if len(rows) == 0:
+            self.initial_table_id = None
             return
 
-        self.initial_id_sb.setValue(int(tabledata[0][0]))
-        self.setRowCount(len(tabledata) + 1)
-        self.number_rows_sb.setValue(len(tabledata))
-        self.initial_table_id = tabledata[0][0]
-
-        for j in range(len(self.column_names)):
-            for i in range(len(tabledata)):
-                item_str = str(tabledata[i][j])
-                if len(item_str) > _max_str_size:
-                    item_str = item_str[:10] + '...'
-                item = _QTableWidgetItem(item_str)
-                item.setFlags(_Qt.ItemIsSelectable | _Qt.ItemIsEnabled)
-                self.setItem(i + 1, j, item)
+        self.initial_table_id = rows[0][0]
+        self.initial_id_sb.setValue(int(self.initial_table_id))
 
     def scrollDown(self):
         """Scroll down."""
         vbar = self.verticalScrollBar()
         vbar.setValue(vbar.maximum())
 
+    def fetchPrevious(self, action=None):
+        """Read the previous rows when the table is scrolled to the top."""
+        vbar = self.verticalScrollBar()
+        if (vbar.sliderPosition() != vbar.minimum()
+           or not self.table_model.canFetchPrevious()):
+            return
+
+        try:
+            nrows = self.table_model.fetchPrevious()
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            return
+
+        if nrows > 0:
+            self.scrollTo(
+                self.table_model.index(nrows, 0),
+                _QAbstractItemView.PositionAtTop)
+
     def selectLine(self):
         """Select the entire line."""
-        if (self.rowCount() == 0
-           or self.columnCount() == 0
+        if (self.table_model.rowCount() == 0
+           or self.table_model.columnCount() == 0
            or len(self.column_names) == 0 or len(self.data_types) == 0):
             return
 
-        selected = self.selectedItems()
-        rows = [s.row() for s in selected]
+        rows = [i.row() for i in self.selectionModel().selectedIndexes()]
 
         if 0 in rows:
             self.setSelectionBehavior(_QAbstractItemView.SelectItems)
         else:
             self.setSelectionBehavior(_QAbstractItemView.SelectRows)
 
-    def filterChanged(self, item):
+    def filterChanged(self, index):
         """Apply column filter to data."""
-        if item.row() == 0:
+        if index.row() == 0:
             self.filterColumn()
 
     def filterColumn(self, initial_id=None):
         """Apply column filter to data."""
-        if (self.rowCount() == 0
-           or self.columnCount() == 0
-           or len(self.column_names) == 0 or len(self.data_types) == 0):
+        if len(self.column_names) == 0 or len(self.data_types) == 0:
             return
-        
+
         try:
-            con = _sqlite3.connect(self.database)
-            cur = con.cursor()
-            column_names_str = ''
-            for col_name in self.column_names:
-                column_names_str = column_names_str + '"{0:s}", '.format(col_name)
-            column_names_str = column_names_str[:-2]
-            cmd = 'SELECT {0:s} FROM {1:s}'.format(
-                column_names_str, self.table_name)
-
-            and_flag = False
-            filters = []
-            for idx in range(len(self.column_names)):
-                filters.append(self.item(0, idx).text())
-    
-            if any(filt != '' for filt in filters):
-                cmd = cmd + ' WHERE '
-    
-            for idx in range(len(self.column_names)):
-                column = self.column_names[idx]
-                data_type = self.data_types[idx]
-                filt = filters[idx]
-    
-                if filt != '':
-    
-                    if and_flag:
-                        cmd = cmd + ' AND '
-                    and_flag = True
-    
-                    if data_type == str:
-                        cmd = cmd + column + ' LIKE "%' + filt + '%"'
-                    else:
-                        if '~' in filt:
-                            fs = filt.split('~')
-                            if len(fs) == 2:
-                                cmd = cmd + column + ' >= ' + fs[0]
-                                cmd = cmd + ' AND '
-                                cmd = cmd + column + ' <= ' + fs[1]
-                        elif filt.lower() == 'none' or filt.lower() == 'null':
-                            cmd = cmd + column + ' IS NULL'
-                        else:
-                            try:
-                                value = data_type(filt)
-                                cmd = cmd + column + ' = ' + str(value)
-                            except ValueError:
-                                cmd = cmd + column + ' ' + filt
-    
-            if initial_id is not None:
-                if 'WHERE' in cmd:
-                    cmd = 'SELECT * FROM (' + cmd + ' AND id >= {0:d} LIMIT {1:d})'.format(
-                        initial_id, _max_number_rows)
-                else:
-                    cmd = 'SELECT * FROM (' + cmd + ' WHERE id >= {0:d} LIMIT {1:d})'.format(
-                        initial_id, _max_number_rows)
-    
-            else:
-                cmd = 'SELECT * FROM (' + cmd + ' ORDER BY id DESC LIMIT {0:d}) ORDER BY id ASC'.format(
-                    _max_number_rows)
-        
-            cur.execute(cmd)
+            self.table_model.select(initial_id=initial_id)
         except Exception:
             traceback.print_exc(file=sys.stdout)
-            pass
 
-        data = cur.fetchall()
-        self.data = data[:]
-        self.addRowsToTable(data)
+        self.updateNumberRows()
 
     def getSelectedIDs(self):
         """Get selected IDs."""
-        selected = self.selectedItems()
-        rows = [s.row() for s in selected if s.row() != 0]
+        rows = [
+            i.row() for i in self.selectionModel().selectedIndexes()
+            if i.row() != 0]
         rows = _np.unique(rows)
 
         selected_ids = []
         for row in rows:
             if 'id_0' in self.column_names and 'id_f' in self.column_names:
-                idx_id_0 = self.column_names.index('id_0')
-                idx_id_f = self.column_names.index('id_f')
-                id_0 = int(self.item(row, idx_id_0).text())
-                id_f = int(self.item(row, idx_id_f).text())
+                id_0 = int(self.table_model.getValue(row, 'id_0'))
+                id_f = int(self.table_model.getValue(row, 'id_f'))
                 for idn in range(id_0, id_f + 1):
                     selected_ids.append(idn)
             elif ('id_0' not in self.column_names
                   and 'id_f' not in self.column_names):
-                idn = int(self.item(row, 0).text())
+                idn = int(self.table_model.getID(row))
                 selected_ids.append(idn)
 
         return selected_ids
+
+
+def compile_filters(column_names, data_types, filters, text_index=None):
+    """Compile the column filters into a parameterized WHERE clause.
+
+    Filter syntax:
+        none or null: the value is NULL.
+        a~b: a <= value <= b. Either limit can be omitted.
+        <a, <=a, >a, >=a, =a, !=a: comparison with a.
+        a*: text starting with a.
+        a: equal to a for numeric columns, text containing a otherwise.
+
+    Equality, comparisons, ranges and prefixes are written so that SQLite
+    can use an index on the column. Text searches of three or more
+    characters use the full-text index of the column, if there is one.
+
+    Args:
+        column_names (list): column names.
+        data_types (list): column data types (int, float or str).
+        filters (list): filter text of each column.
+        text_index (tuple): full-text index table name and indexed
+            columns, as returned by database.get_text_index.
+
+    Returns:
+        tuple (list of conditions, list of parameters).
+    """
+    conditions = []
+    params = []
+    for column, data_type, filt in zip(column_names, data_types, filters):
+        filt = filt.strip()
+        if filt == '':
+            continue
+        if (text_index is not None and data_type == str
+           and column in text_index[1]
+           and _is_text_search_filter(filt)):
+            condition = (
+                'id IN (SELECT rowid FROM "{0:s}" '
+                'WHERE "{1:s}" MATCH ?)'.format(text_index[0], column))
+            condition_params = ['"' + filt.replace('"', '""') + '"']
+        else:
+            condition, condition_params = _compile_filter(
+                '"{0:s}"'.format(column), data_type, filt)
+        conditions.append(condition)
+        params.extend(condition_params)
+    return conditions, params
+
+
+def _is_text_search_filter(filt):
+    return (
+        len(filt) >= 3 and filt.lower() not in ('none', 'null')
+        and '~' not in filt and '*' not in filt
+        and _re.match(r'^(<=|>=|!=|<|>|=)', filt) is None)
+
+
+def _compile_filter(column, data_type, filt):
+    if filt.lower() in ('none', 'null'):
+        return column + ' IS NULL', []
+
+    if '~' in filt:
+        fs = [f.strip() for f in filt.split('~')]
+        if len(fs) != 2:
+            raise ValueError('Invalid range filter: %s' % filt)
+        conditions = []
+        params = []
+        if fs[0] != '':
+            conditions.append(column + ' >= ?')
+            params.append(data_type(fs[0]))
+        if fs[1] != '':
+            conditions.append(column + ' <= ?')
+            params.append(data_type(fs[1]))
+        if len(conditions) == 0:
+            raise ValueError('Invalid range filter: %s' % filt)
+        return ' AND '.join(conditions), params
+
+    match = _re.match(r'^(<=|>=|!=|<|>|=)\s*(.*)$', filt)
+    if match is not None:
+        operator, value = match.groups()
+        return column + ' ' + operator + ' ?', [data_type(value)]
+
+    if data_type != str:
+        return column + ' = ?', [data_type(filt)]
+
+    if filt.endswith('*') and len(filt) > 1 and '*' not in filt[:-1]:
+        prefix = filt[:-1]
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return column + ' >= ? AND ' + column + ' < ?', [prefix, upper]
+
+    escaped = filt.replace(
+        '\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return column + " LIKE ? ESCAPE '\\'", ['%' + escaped + '%']
+
+
+def _update_database(database):
+    """Update the indexes and the derived results table of a database.
+
+    This runs in a DatabaseLoader thread, after the table rows are read.
+    The derived results update stops between chunks if the thread is
+    interrupted.
+    """
+    _database.create_indexes(database)
+    _database.update_derived_results(
+        database, create=False,
+        stop=_QThread.currentThread().isInterruptionRequested)
+
@@ -1,12 +1,43 @@
 """Read rotating coil measurement file."""
 
+import io as _io
 import os as _os
 import re as _re
+import bz2 as _bz2
+import gzip as _gzip
+import json as _json
+import lzma as _lzma
+import zipfile as _zipfile
+import contextlib as _contextlib
 import time as _time
+import hashlib as _hashlib
 import numpy as _np
 import pandas as _pd
 import datetime as _datetime
-import sqlite3 as _sqlite3
+import concurrent.futures as _futures
+
+from . import database as _database
+
+
+_read_data_labels = ['Reading Data', 'Dados de Leitura']
+_raw_data_labels = ['Raw Data Stored', 'Dados Brutos']
+
+_compressed_file_openers = {
+    '.gz': _gzip.open,
+    '.xz': _lzma.open,
+    '.bz2': _bz2.open,
+    }
+_measurement_file_extensions = ('.dat', '.dat.gz', '.dat.xz', '.dat.bz2')
+_database_chunk_size = _database._chunk_size
+_parallel_min_items = 500
+_database_text_columns = ['read_data', 'raw_curve']
+
+_cache_excluded_attributes = [
+    '_filename', '_idn', '_database', '_read_curves', '_cache', '_keep_text',
+    '_curves_dtype',
+    '_measurement_data', '_header_index', '_read_data', '_raw_curve',
+    '_multipoles', '_curves', '_multipoles_df', '_curves_df',
+    ]
 
 
 class MeasurementDataError(Exception):
@@ -14,31 +45,138 @@ class MeasurementDataError(Exception):
 
     def __init__(self, message, *args):
         """Initialize variables."""
+        super().__init__(message, *args)
         self.message = message
 
 
 class MeasurementData(object):
     """Rotationg coil measurement data."""
 
+    __slots__ = (
+        '_idn', '_filename', '_database', '_read_curves', '_cache',
+        '_keep_text', '_curves_dtype', '_measurement_data', '_header_index',
+        '_magnet_name', '_date', '_hour', '_operator', '_software_version',
+        '_bench', '_temperature_magnet', '_temperature_water',
+        '_rotation_motor_speed', '_rotation_motor_acceleration',
+        '_coil_rotation_direction', '_integrator_gain', '_trigger_ref',
+        '_n_integration_points', '_n_turns', '_n_collections',
+        '_analysis_interval', '_main_coil_current_avg',
+        '_main_coil_current_std', '_ch_coil_current_avg',
+        '_ch_coil_current_std', '_cv_coil_current_avg', '_cv_coil_current_std',
+        '_qs_coil_current_avg', '_qs_coil_current_std',
+        '_trim_coil_current_avg', '_trim_coil_current_std',
+        '_main_coil_volt_avg', '_main_coil_volt_std', '_magnet_resistance_avg',
+        '_magnet_resistance_std', '_accelerator_type', '_magnet_model',
+        '_main_harmonic', '_skew_magnet', '_magnet_family', '_coil_name',
+        '_coil_type', '_measurement_type', '_n_turns_normal',
+        '_radius1_normal', '_radius2_normal', '_n_turns_bucked',
+        '_radius1_bucked', '_radius2_bucked', '_comments',
+        '_normalization_radius', '_magnetic_center_x', '_magnetic_center_y',
+        '_read_data', '_raw_curve', '_magnetic_center_x_err',
+        '_magnetic_center_y_err', '_multipoles_df', '_multipoles', '_curves',
+        '_curves_df', '_columns_names', '_raw_curve_mult_factor',
+        '_raw_curve_mult_factor_mod', '_raw_curve_mult_factor_mod_date',
+        )
+
     _n_harmonics = 15
 
-    def __init__(self, filename=None, idn=None, database=None):
+    def __init__(self, filename=None, idn=None, database=None,
+                 read_curves=True, cache=None, keep_text=False,
+                 curves_dtype=_np.float64):
         """Read data from file.
 
         Args:
             filename (str): rotating coil file path.
             id (int): measurement id in database table
+            read_curves (bool): if False, the raw curves are only read
+                on the first access to curves, curves_df, raw_curve or
+                raw_data_avg.
+            cache (MeasurementDataCache): cache of parsed measurement
+                files, used only when reading from file.
+            keep_text (bool): if False, the source text lines are released
+                after parsing and read_data and raw_curve are read again
+                from the file or database when accessed.
+            curves_dtype (dtype): storage type of the raw curves. Statistics
+                of the raw curves are always accumulated in float64.
         """
         if ((filename is None and idn is None)
            or (filename is not None and idn is not None)
            or (idn is not None and database is None)):
             raise ValueError('Invalid arguments for MeasurementData.')
 
+        self._init_attributes(
+            filename, idn, database, read_curves, cache, keep_text,
+            curves_dtype)
+
+        if self._idn is not None:
+            self._read_from_database()
+        elif self._cache is not None and self._cache.load(self):
+            if self._read_curves:
+                self._load_raw_curves()
+        else:
+            self._read_from_file()
+            if self._cache is not None:
+                self._cache.save(self)
+
+        self._release_text()
+
+    @classmethod
+    def from_database(cls, database, idns, read_curves=True, keep_text=False,
+                      curves_dtype=_np.float64):
+        """Read many measurements from database with a single connection.
+
+        Args:
+            database (str): database file path.
+            idns (list): measurement ids in database table.
+            read_curves (bool): read the raw curves while loading.
+            keep_text (bool): keep the source text after parsing.
+            curves_dtype (dtype): storage type of the raw curves.
+
+        Returns:
+            list of MeasurementData objects in the order of idns.
+        """
+        conn = _database.get_connection(database)
+
+        idns = [int(idn) for idn in idns]
+        rows = {}
+        with _contextlib.closing(conn.cursor()) as cur:
+            columns_str = _get_measurements_columns_str(cur, read_curves)
+            unique_idns = sorted(set(idns))
+            for i in range(0, len(unique_idns), _database_chunk_size):
+                chunk = unique_idns[i:i + _database_chunk_size]
+                cmd = 'SELECT {0:s} FROM measurements WHERE id IN ({1:s})'
+                cur.execute(
+                    cmd.format(columns_str, ', '.join('?'*len(chunk))), chunk)
+                description = [d[0] for d in cur.description]
+                idx_id = description.index('id')
+                for row in cur.fetchall():
+                    rows[row[idx_id]] = row
+
+        data = []
+        for idn in idns:
+            if idn not in rows:
+                raise ValueError('Invalid database ID.')
+            md = cls.__new__(cls)
+            md._init_attributes(
+                None, idn, database, read_curves, None, keep_text,
+                curves_dtype)
+            md._set_database_row(description, rows[idn])
+            md._release_text()
+            data.append(md)
+        return data
+
+    def _init_attributes(self, filename, idn, database, read_curves, cache,
+                         keep_text, curves_dtype):
         self._idn = idn
         self._filename = filename
         self._database = database
+        self._read_curves = read_curves
+        self._cache = cache
+        self._keep_text = keep_text
+        self._curves_dtype = _np.dtype(curves_dtype)
 
         self._measurement_data = None
+        self._header_index = None
         self._magnet_name = None
         self._date = None
         self._hour = None
@@ -102,11 +240,6 @@ class MeasurementData(object):
         self._raw_curve_mult_factor_mod = 1
         self._raw_curve_mult_factor_mod_date = '12/03/2018'
 
-        if self._idn is not None:
-            self._read_from_database()
-        else:
-            self._read_from_file()
-
     @property
     def filename(self):
         """Name of the measurement data file (str)."""
@@ -360,11 +493,15 @@ class MeasurementData(object):
     @property
     def read_data(self):
         """String with the multipoles table data (str)."""
+        if self._read_data is None:
+            self._load_read_data()
         return self._read_data
 
     @property
     def raw_curve(self):
         """String with the raw curves table data (str)."""
+        if self._raw_curve is None:
+            self._load_raw_curves(reload=True)
         return self._raw_curve
 
     @property
@@ -385,6 +522,8 @@ class MeasurementData(object):
     @property
     def multipoles_df(self):
         """Multipole DataFrame."""
+        if self._multipoles_df is None and self._multipoles is not None:
+            self._create_multipoles_data_frame()
         return self._multipoles_df
 
     @property
@@ -406,11 +545,15 @@ class MeasurementData(object):
     @property
     def curves(self):
         """Curves."""
+        self._load_raw_curves()
         return self._curves
 
     @property
     def curves_df(self):
         """Curve DataFrame."""
+        if self._curves_df is None:
+            self._load_raw_curves()
+            self._create_curves_data_frame()
         return self._curves_df
 
     @property
@@ -445,7 +588,12 @@ class MeasurementData(object):
     @property
     def raw_data_avg(self):
         """Average of raw data."""
-        return self._curves_df.mean(axis=1).values
+        return _np.nanmean(self.curves, axis=1, dtype=_np.float64)
+
+    @property
+    def raw_data_std(self):
+        """Standard deviation of raw data."""
+        return _np.nanstd(self.curves, axis=1, dtype=_np.float64, ddof=1)
 
     def _update_raw_curve_mult_factor(self):
         date_sec = _time.mktime(_datetime.datetime.strptime(
@@ -455,25 +603,74 @@ class MeasurementData(object):
         if date_sec >= mod_date_sec:
             self._raw_curve_mult_factor = self._raw_curve_mult_factor_mod
 
-    def _read_from_database(self):
-        if not _os.path.isfile(self._database):
-            raise IOError('File not found: %s' % self._database)
+    def _release_text(self):
+        if self._keep_text:
+            return
 
+        self._measurement_data = None
+        self._header_index = None
+        self._read_data = None
+        self._raw_curve = None
+
+    def _load_raw_curves(self, reload=False):
+        if self._curves is not None and not reload:
+            return
+
+        if self._idn is not None:
+            self._read_raw_curves_from_database(text=reload)
+        elif self._filename is not None:
+            if (reload or self._cache is None
+               or not self._cache.load_curves(self)):
+                self._read_raw_curves_from_file()
+
+        if not reload:
+            self._release_text()
+
+    def _load_read_data(self):
+        if self._idn is not None:
+            conn = _database.get_connection(self._database)
+            with _contextlib.closing(conn.cursor()) as cur:
+                cur.execute(
+                    'SELECT read_data FROM measurements WHERE id = ?',
+                    (self._idn, ))
+                read_data = cur.fetchone()[0]
+            self._read_data = [
+                l for l in read_data.split('\n') if len(l) != 0]
+        elif self._filename is not None:
+            with _open_measurement_file(self._filename) as arq:
+                filelines = _read_lines_until(arq, _raw_data_labels)
+            lines = [line for line in filelines if len(line) != 0]
+            index = _search_in_file_lines(lines, _read_data_labels)
+            if index is not None:
+                index_multipoles = index + 1
+                self._read_data = lines[
+                    index_multipoles:index_multipoles + self._n_harmonics + 1]
+
+    def _read_from_database(self):
         if self._idn is None:
             raise ValueError('Invalid measurement ID.')
 
-        conn = _sqlite3.connect(self._database)
-        cur = conn.cursor()
-        cur.execute('SELECT * FROM measurements WHERE id = ?', (self._idn, ))
-        meas = cur.fetchone()
-        description = [d[0] for d in cur.description]
+        conn = _database.get_connection(self._database)
+        with _contextlib.closing(conn.cursor()) as cur:
+            columns_str = _get_measurements_columns_str(
+                cur, self._read_curves)
+            cur.execute(
+                'SELECT {0:s} FROM measurements WHERE id = ?'.format(
+                    columns_str), (self._idn, ))
+            meas = cur.fetchone()
+            description = [d[0] for d in cur.description]
 
         if meas is None:
             raise ValueError('Invalid database ID.')
 
+        self._set_database_row(description, meas)
+
+    def _set_database_row(self, description, meas):
+        excluded_columns = (
+            ['id', 'analisys_interval'] +
+            _database_text_columns + _database._binary_columns)
         for name in description:
-            if (name not in
-               ['id', 'analisys_interval', 'read_data', 'raw_curve']):
+            if name not in excluded_columns:
                 idx = description.index(name)
                 att_name = '_' + name
                 if hasattr(self, att_name):
@@ -488,22 +685,24 @@ class MeasurementData(object):
         read_data = meas[description.index('read_data')]
         self._read_data = [l for l in read_data.split('\n') if len(l) != 0]
 
-        raw_curve = meas[description.index('raw_curve')]
-        self._raw_curve = [l for l in raw_curve.split('\n') if len(l) != 0]
+        if self._read_curves:
+            self._get_raw_curves_from_database_data(
+                meas[description.index('raw_curve')],
+                _get_column_value(description, meas, 'curves_bin'))
 
         columns_names_str = self._read_data[0]
         self._columns_names = columns_names_str.split()
 
-        multipoles = []
-        for value in self._read_data[1:]:
-            multipoles.append(value.split())
-        self._multipoles = _np.array(multipoles).astype(_np.float64)
-
-        curves = []
-        for value in self._raw_curve[2:]:
-            curves.append(value.split()[1:])
-        self._curves = _np.array(curves).astype(
-            _np.float64)*self._raw_curve_mult_factor
+        multipoles_bin = _get_column_value(
+            description, meas, 'multipoles_bin')
+        if multipoles_bin is not None:
+            self._multipoles = _database.decode_array(
+                multipoles_bin).astype(_np.float64, copy=False)
+        else:
+            multipoles = []
+            for value in self._read_data[1:]:
+                multipoles.append(value.split())
+            self._multipoles = _np.array(multipoles).astype(_np.float64)
 
         if self._magnet_model in [1, 2, 3]:
             self._main_harmonic = self._magnet_model
@@ -522,27 +721,62 @@ class MeasurementData(object):
             self._skew_magnet = False
 
         self._set_magnet_center_error()
-        self._create_data_frames()
+
+    def _read_raw_curves_from_database(self, text=False):
+        conn = _database.get_connection(self._database)
+        with _contextlib.closing(conn.cursor()) as cur:
+            if text:
+                columns_str = '"raw_curve"'
+            else:
+                columns_str = _get_raw_curve_columns_str(cur)
+            cur.execute(
+                'SELECT {0:s} FROM measurements WHERE id = ?'.format(
+                    columns_str), (self._idn, ))
+            meas = cur.fetchone()
+            description = [d[0] for d in cur.description]
+        self._get_raw_curves_from_database_data(
+            meas[description.index('raw_curve')],
+            _get_column_value(description, meas, 'curves_bin'))
+
+    def _get_raw_curves_from_database_data(self, raw_curve, curves_bin=None):
+        if curves_bin is not None:
+            self._raw_curve = None
+            curves = _database.decode_array(curves_bin).astype(_np.float64)
+            curves *= self._raw_curve_mult_factor
+            self._curves = curves.astype(self._curves_dtype, copy=False)
+            return
+
+        self._raw_curve = [l for l in raw_curve.split('\n') if len(l) != 0]
+        self._curves = _decode_raw_curves(
+            self._raw_curve[2:], self._raw_curve_mult_factor,
+            dtype=self._curves_dtype)
 
     def _read_from_file(self):
-        if not _os.path.isfile(self._filename):
+        st = _stat_measurement_file(self._filename)
+        if st is None:
             message = 'File not found: "%s"' % self._filename
             raise IOError(message)
 
-        if _os.stat(self._filename).st_size == 0:
+        if st[0] == 0:
             message = 'Empty file: "%s"' % self._filename
             raise MeasurementDataError(message)
 
-        arq = open(self._filename, encoding="latin1")
-
         # Read file lines
-        filelines = arq.read().splitlines()
+        with _open_measurement_file(self._filename) as arq:
+            if self._read_curves:
+                filelines = arq.read().splitlines()
+            else:
+                filelines = _read_lines_until(arq, _raw_data_labels)
         self._measurement_data = [line for line in filelines if len(line) != 0]
+        if len(self._measurement_data) == 0:
+            message = 'Empty file: "%s"' % self._filename
+            raise MeasurementDataError(message)
+        self._header_index = _index_header_lines(self._measurement_data)
 
         filename_split = (
             _os.path.split(self._filename)[1].split('.')[0].split('_'))
 
-        magnet_name = _find_value(self._measurement_data, ['file', 'arquivo'])
+        magnet_name = _find_value(self._header_index, ['file', 'arquivo'])
         if magnet_name is not None:
             self._magnet_name = magnet_name.split('\\')[-1].split('_')[0]
         else:
@@ -556,88 +790,88 @@ class MeasurementData(object):
                 '\d+|\D+', self._magnet_name))
 
         # Read Date
-        self._date = _find_value(self._measurement_data, ['date', 'data'])
+        self._date = _find_value(self._header_index, ['date', 'data'])
         if self._date is None and len(filename_split) > 1:
             self._date = filename_split[-2]
         self._update_raw_curve_mult_factor()
 
         # Read Hour
-        self._hour = _find_value(self._measurement_data, ['hour', 'hora'])
+        self._hour = _find_value(self._header_index, ['hour', 'hora'])
         if self._hour is None and len(filename_split) > 2:
             self._hour = filename_split[-1]
 
         self._magnetic_center_x = _find_value(
-            self._measurement_data, 'magnetic_center_x', vtype=float)
+            self._header_index, 'magnetic_center_x', vtype=float)
 
         self._magnetic_center_y = _find_value(
-            self._measurement_data, 'magnetic_center_y', vtype=float)
+            self._header_index, 'magnetic_center_y', vtype=float)
 
         self._get_measurement_settings_from_file_data()
         self._get_data_settings_from_file_data()
         self._get_aux_settings_from_file_data()
         self._get_coil_settings_from_file_data()
         self._get_multipoles_from_file_data()
-        self._get_raw_curves_from_file_data()
+        if self._read_curves:
+            self._get_raw_curves_from_file_data(self._measurement_data)
         self._set_magnet_center_error()
-        self._create_data_frames()
 
     def _get_measurement_settings_from_file_data(self):
-        self._operator = _find_value(self._measurement_data, 'operator')
+        self._operator = _find_value(self._header_index, 'operator')
 
         self._software_version = _find_value(
-            self._measurement_data, 'software_version')
+            self._header_index, 'software_version')
 
         self._temperature_magnet = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['temperature', 'temperatura_ima'],
             vtype=float)
 
         self._coil_rotation_direction = _find_value(
-            self._measurement_data, ['rotation', 'sentido_de_rotacao'])
+            self._header_index, ['rotation', 'sentido_de_rotacao'])
 
         self._n_collections = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['n_collections', 'nr_collections', 'nr_coletas'],
             vtype=int)
 
         interval = _find_value(
-            self._measurement_data, ['analysis_interval', 'intervalo_analise'])
+            self._header_index, ['analysis_interval', 'intervalo_analise'])
         if interval is not None:
             mn = interval.split('-')
             self._analysis_interval = [int(mn[0]), int(mn[1])]
 
         self._measurement_type = _find_value(
-            self._measurement_data, ['measurement_type', 'tipo_medicao'])
+            self._header_index, ['measurement_type', 'tipo_medicao'])
 
         self._comments = _find_value(
-            self._measurement_data, ['comments', 'observacoes'])
+            self._header_index, ['comments', 'observacoes'])
 
     def _get_data_settings_from_file_data(self):
-        self._bench = _find_value(self._measurement_data, 'bench')
+        self._bench = _find_value(self._header_index, 'bench')
 
         self._rotation_motor_speed = _find_value(
-            self._measurement_data, ['velocity', 'velocidade'], vtype=float)
+            self._header_index, ['velocity', 'velocidade'], vtype=float)
 
         self._rotation_motor_acceleration = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['acceleration', 'aceleracao'], vtype=float)
 
         self._integrator_gain = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['integrator_gain', 'ganho_integrador'], vtype=int)
 
         self._n_integration_points = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['n_integration_points', 'nr_integration_points',
              'nr_pontos_integracao'], vtype=int)
 
         self._n_turns = _find_value(
-            self._measurement_data, ['n_turns', 'nr_turns', 'nr_voltas'],
+            self._header_index, ['n_turns', 'nr_turns', 'nr_voltas'],
             vtype=int)
 
     def _get_aux_settings_from_file_data(self):
         self._main_coil_current_avg = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['main_coil_current_avg', 'corrente_alim_principal_avg'],
             vtype=float)
 
@@ -648,49 +882,49 @@ class MeasurementData(object):
             raise MeasurementDataError(message)
 
         self._main_coil_current_std = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['main_coil_current_std', 'corrente_alim_principal_std'],
             vtype=float)
 
         self._trim_coil_current_avg = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['trim_coil_current_avg', 'corrente_alim_secundaria_avg'],
             vtype=float)
 
         self._trim_coil_current_std = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['trim_coil_current_std', 'corrente_alim_secundaria_std'],
             vtype=float)
 
         self._ch_coil_current_avg = _find_value(
-            self._measurement_data, 'ch_coil_current_avg', vtype=float)
+            self._header_index, 'ch_coil_current_avg', vtype=float)
 
         self._ch_coil_current_std = _find_value(
-            self._measurement_data, 'ch_coil_current_std', vtype=float)
+            self._header_index, 'ch_coil_current_std', vtype=float)
 
         self._cv_coil_current_avg = _find_value(
-            self._measurement_data, 'cv_coil_current_avg', vtype=float)
+            self._header_index, 'cv_coil_current_avg', vtype=float)
 
         self._cv_coil_current_std = _find_value(
-            self._measurement_data, 'cv_coil_current_std', vtype=float)
+            self._header_index, 'cv_coil_current_std', vtype=float)
 
         self._qs_coil_current_avg = _find_value(
-            self._measurement_data, 'qs_coil_current_avg', vtype=float)
+            self._header_index, 'qs_coil_current_avg', vtype=float)
 
         self._qs_coil_current_std = _find_value(
-            self._measurement_data, 'qs_coil_current_std', vtype=float)
+            self._header_index, 'qs_coil_current_std', vtype=float)
 
         self._main_coil_volt_avg = _find_value(
-            self._measurement_data, 'main_coil_volt_avg', vtype=float)
+            self._header_index, 'main_coil_volt_avg', vtype=float)
 
         self._main_coil_volt_std = _find_value(
-            self._measurement_data, 'main_coil_volt_std', vtype=float)
+            self._header_index, 'main_coil_volt_std', vtype=float)
 
         self._magnet_resistance_avg = _find_value(
-            self._measurement_data, 'magnet_resistance', vtype=float)
+            self._header_index, 'magnet_resistance', vtype=float)
 
         self._magnet_resistance_std = _find_value(
-            self._measurement_data, 'magnet_resistance_std', vtype=float)
+            self._header_index, 'magnet_resistance_std', vtype=float)
 
         if (self._magnet_resistance_std is None
            and self._magnet_resistance_avg is not None):
@@ -701,48 +935,48 @@ class MeasurementData(object):
 
     def _get_coil_settings_from_file_data(self):
         self._trigger_ref = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['pulse_start_collect', 'pulso_start_coleta'], vtype=int)
 
         self._coil_name = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['rotating_coil_name', 'nome_bobina_girante'])
 
         self._coil_type = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['rotating_coil_type', 'tipo_bobina_girante'])
 
         self._n_turns_normal = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['n_turns_main_coil', 'n_espiras_bobina_principal'], vtype=int)
 
         self._radius1_normal = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['main_coil_internal_radius', 'raio_interno_bobina_princip'],
             vtype=float)
 
         self._radius2_normal = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['main_coil_external_radius', 'raio_externo_bobina_princip'],
             vtype=float)
 
         self._n_turns_bucked = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['n_turns_bucked_coil', 'n_espiras_bobina_bucked'], vtype=int)
 
         self._radius1_bucked = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['bucked_coil_internal_radius', 'raio_interno_bobina_bucked'],
             vtype=float)
 
         self._radius2_bucked = _find_value(
-            self._measurement_data,
+            self._header_index,
             ['bucked_coil_external_radius', 'raio_externo_bobina_bucked'],
             vtype=float)
 
     def _get_multipoles_from_file_data(self):
         index_read_data = _search_in_file_lines(
-            self._measurement_data, ['Reading Data', 'Dados de Leitura'])
+            self._measurement_data, _read_data_labels)
 
         if index_read_data is not None:
             index_multipoles = index_read_data + 1
@@ -842,29 +1076,35 @@ class MeasurementData(object):
              (perp_mult[n-1]*main_mult_err[n]/(
                 n*(main_mult[n]**2)))**2)**(1/2))*1e6
 
-    def _get_raw_curves_from_file_data(self):
-        index = _search_in_file_lines(
-            self._measurement_data, ['Raw Data Stored', 'Dados Brutos'])
+    def _read_raw_curves_from_file(self):
+        with _open_measurement_file(self._filename) as arq:
+            filelines = arq.read().splitlines()
+        lines = [line for line in filelines if len(line) != 0]
+        self._get_raw_curves_from_file_data(lines)
+        if self._cache is not None:
+            self._cache.save(self)
+
+    def _get_raw_curves_from_file_data(self, lines):
+        index = _search_in_file_lines(lines, _raw_data_labels)
 
         if index is not None:
-            self._raw_curve = self._measurement_data[index+3:]
+            self._raw_curve = lines[index+3:]
         else:
             message = (
                 'Failed to read raw data from file: \n\n"%s"' % self._filename)
             raise MeasurementDataError(message)
 
-        curves = []
-        for value in self._raw_curve[1:]:
-            curves.append(value.split()[1:])
-        self._curves = _np.array(curves).astype(
-            _np.float64)*self._raw_curve_mult_factor
+        self._curves = _decode_raw_curves(
+            self._raw_curve[1:], self._raw_curve_mult_factor,
+            dtype=self._curves_dtype)
 
-    def _create_data_frames(self):
+    def _create_multipoles_data_frame(self):
         index = _np.char.mod('%d', _np.linspace(
             1, self._n_harmonics, self._n_harmonics))
         self._multipoles_df = _pd.DataFrame(
             self._multipoles, columns=self._columns_names, index=index)
 
+    def _create_curves_data_frame(self):
         npoints = self._curves.shape[0]
         ncurves = self._curves.shape[1]
         index = _np.char.mod('%d', _np.linspace(1, npoints, npoints))
@@ -873,20 +1113,19 @@ class MeasurementData(object):
             self._curves, index=index, columns=columns)
 
     def calc_integrated_field(self, pos):
-        if self._multipoles is None or self.main_harmonic is None:
-            return
+        """Calculate integrated field.
 
-        nr_harmonics = self._multipoles.shape[0]
-        nrpts = len(pos)
-        int_field_x = _np.zeros(nrpts)
-        int_field_y = _np.zeros(nrpts)
+        Args:
+            pos (array): transversal position values [m].
 
-        for i in range(nrpts):
-            for n in range(nr_harmonics):
-                int_field_x[i] += self.skew_multipoles[n]*(pos[i]**n)
-                int_field_y[i] += self.normal_multipoles[n]*(pos[i]**n)
+        Returns:
+            int_field_x (array): skew integrated field [T.m].
+            int_field_y (array): normal integrated field [T.m].
+        """
+        if self._multipoles is None or self.main_harmonic is None:
+            return
 
-        return int_field_x, int_field_y
+        return calc_integrated_field(self._multipoles, pos)
 
     def calc_residual_field(self, pos):
         """Calculate residual field.
@@ -901,26 +1140,8 @@ class MeasurementData(object):
         if self._multipoles is None or self.main_harmonic is None:
             return None, None
 
-        n = self.main_harmonic - 1
-        nr_harmonics = self._multipoles.shape[0]
-
-        nrpts = len(pos)
-        residual_normal = _np.zeros(nrpts)
-        residual_skew = _np.zeros(nrpts)
-
-        normal = self._multipoles[:, 1]
-        skew = self._multipoles[:, 3]
-
-        if self.skew_magnet:
-            main_mult = skew[n]
-        else:
-            main_mult = normal[n]
-
-        for i in range(nrpts):
-            for m in range(n+1, nr_harmonics):
-                residual_normal[i] += (normal[m]/main_mult)*(pos[i]**(m - n))
-                residual_skew[i] += (skew[m]/main_mult)*(pos[i]**(m - n))
-
+        residual_normal, residual_skew, _, _ = calc_residuals(
+            self._multipoles, self.main_harmonic, self.skew_magnet, pos)
         return residual_normal, residual_skew
 
     def calc_residual_multipoles(self, pos):
@@ -936,48 +1157,801 @@ class MeasurementData(object):
         if self._multipoles is None or self.main_harmonic is None:
             return None, None
 
-        n = self.main_harmonic - 1
-        nr_harmonics = self._multipoles.shape[0]
+        _, _, residual_mult_normal, residual_mult_skew = calc_residuals(
+            self._multipoles, self.main_harmonic, self.skew_magnet, pos)
+        return residual_mult_normal, residual_mult_skew
 
-        nrpts = len(pos)
-        residual_mult_normal = _np.zeros([nr_harmonics, nrpts])
-        residual_mult_skew = _np.zeros([nr_harmonics, nrpts])
 
-        normal = self._multipoles[:, 1]
-        skew = self._multipoles[:, 3]
+class MeasurementDataCache(object):
+    """Persistent cache of parsed measurement files.
 
-        if self.skew_magnet:
-            main_mult = skew[n]
+    Each entry stores the header values, the multipoles and, if already
+    read, the raw curves of one file. Entries are keyed by file path, size
+    and modification time, and the least recently used entries are removed
+    when the total size exceeds max_size, down to a fraction of max_size.
+    The total size is tracked as entries are saved, so the cache directory
+    is only listed on the first save and when entries are removed.
+
+    The raw curves are read from an entry only when they are needed, and
+    only if they were stored with at least the precision of the requested
+    curves type.
+    """
+
+    _version = 1
+    _evict_fraction = 0.8
+
+    def __init__(self, directory, max_size=500*1024**2):
+        """Initialize variables.
+
+        Args:
+            directory (str): cache directory path.
+            max_size (int): maximum total size of the cache files [bytes].
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self._total_size = None
+        if not _os.path.isdir(self.directory):
+            _os.makedirs(self.directory)
+
+    def _get_entry_path(self, filename):
+        digest = _hashlib.sha1(
+            _os.path.abspath(filename).encode('utf-8')).hexdigest()
+        return _os.path.join(self.directory, digest + '.npz')
+
+    def _get_key(self, filename):
+        st = _stat_measurement_file(filename)
+        if st is None:
+            raise IOError('File not found: "%s"' % filename)
+        return [
+            str(self._version), _os.path.abspath(filename),
+            str(st[0]), str(st[1])]
+
+    def _open_entry(self, filename):
+        key = self._get_key(filename)
+        path = self._get_entry_path(filename)
+        if not _os.path.isfile(path):
+            return None
+
+        entry = _np.load(path, allow_pickle=False)
+        if entry['key'].tolist() != key:
+            entry.close()
+            return None
+        return entry
+
+    def load(self, md):
+        """Load cached header values and multipoles into a MeasurementData.
+
+        The raw curves are not loaded (see load_curves).
+
+        Returns:
+            True if a valid entry was found, False otherwise.
+        """
+        try:
+            entry = self._open_entry(md.filename)
+            if entry is None:
+                return False
+
+            with entry:
+                header = _json.loads(str(entry['header']))
+                multipoles = entry['multipoles']
+
+            _os.utime(self._get_entry_path(md.filename))
+        except Exception:
+            return False
+
+        for name, value in header.items():
+            setattr(md, name, value)
+        md._multipoles = multipoles
+        return True
+
+    def load_curves(self, md):
+        """Load cached raw curves into a MeasurementData object.
+
+        Returns:
+            True if the entry has raw curves stored with at least the
+            precision of the MeasurementData curves type, False otherwise.
+        """
+        try:
+            entry = self._open_entry(md.filename)
+            if entry is None:
+                return False
+
+            with entry:
+                if 'curves' not in entry.files:
+                    return False
+                curves = entry['curves']
+        except Exception:
+            return False
+
+        if curves.dtype.itemsize < md._curves_dtype.itemsize:
+            return False
+
+        md._curves = curves.astype(md._curves_dtype, copy=False)
+        return True
+
+    def save(self, md):
+        """Save the parsed values of a MeasurementData object."""
+        header = {}
+        for name in MeasurementData.__slots__:
+            if name not in _cache_excluded_attributes:
+                header[name] = getattr(md, name)
+
+        arrays = {
+            'key': _np.array(self._get_key(md.filename)),
+            'header': _np.array(_json.dumps(header, default=_to_json)),
+            'multipoles': md._multipoles,
+            }
+        if md._curves is not None:
+            arrays['curves'] = md._curves
+
+        path = self._get_entry_path(md.filename)
+        tmp_path = path + '.tmp%d' % _os.getpid()
+        try:
+            old_size = _os.path.getsize(path) if _os.path.isfile(path) else 0
+            with open(tmp_path, 'wb') as f:
+                _np.savez(f, **arrays)
+            _os.replace(tmp_path, path)
+            new_size = _os.path.getsize(path)
+        except OSError:
+            if _os.path.isfile(tmp_path):
+                _os.remove(tmp_path)
+            return
+
+        if self._total_size is None:
+            self.trim()
+            return
+
+        self._total_size += new_size - old_size
+        if self._total_size > self.max_size:
+            self._evict()
+
+    def trim(self):
+        """Remove the least recently used entries if the cache is too big.
+
+        The cache directory is listed again, so the entries saved by other
+        processes are also counted.
+        """
+        self._total_size = sum(st.st_size for _, st in self._get_entries())
+        if self._total_size > self.max_size:
+            self._evict()
+
+    def clear(self):
+        """Remove all cache entries."""
+        for path, _ in self._get_entries():
+            try:
+                _os.remove(path)
+            except OSError:
+                pass
+        self._total_size = 0
+
+    def _get_entries(self):
+        entries = []
+        for name in _os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = _os.path.join(self.directory, name)
+                try:
+                    entries.append((path, _os.stat(path)))
+                except OSError:
+                    pass
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._get_entries(), key=lambda e: e[1].st_mtime)
+        total_size = sum(st.st_size for _, st in entries)
+        max_size = self.max_size*self._evict_fraction
+        for path, st in entries:
+            if total_size <= max_size:
+                break
+            try:
+                _os.remove(path)
+                total_size -= st.st_size
+            except OSError:
+                pass
+        self._total_size = total_size
+
+
+class MeasurementFileIndex(object):
+    """Persistent index of the measurement files in a directory.
+
+    The index keeps the file names sorted by the timestamp in the name,
+    with the size, modification time and a header summary of each file.
+    The directory entries are listed and checked on every update, but only
+    new or modified files are read.
+    """
+
+    _version = 1
+    _summary_keys = {
+        'date': (['date', 'data'], str),
+        'hour': (['hour', 'hora'], str),
+        'main_coil_current_avg': (
+            ['main_coil_current_avg', 'corrente_alim_principal_avg'], float),
+        'measurement_type': (['measurement_type', 'tipo_medicao'], str),
+        }
+
+    def __init__(self, directory, index_directory):
+        """Initialize variables and load the saved index.
+
+        Args:
+            directory (str): measurement files directory path.
+            index_directory (str): directory where the index is saved.
+        """
+        self.directory = _os.path.abspath(directory)
+        self.index_directory = index_directory
+        if not _os.path.isdir(self.index_directory):
+            _os.makedirs(self.index_directory)
+
+        self._entries = {}
+        self._filenames = []
+        self._load()
+
+    @property
+    def filenames(self):
+        """Measurement file names sorted by timestamp (list)."""
+        return list(self._filenames)
+
+    def get_summary(self, filename):
+        """Get the header summary of a measurement file (dict)."""
+        entry = self._entries.get(filename)
+        return None if entry is None else entry['summary']
+
+    def update(self):
+        """Update the index with the changed directory entries.
+
+        Returns:
+            True if the file list or any file entry changed, False otherwise.
+        """
+        changed = False
+        entries = {}
+        for dir_entry in _os.scandir(self.directory):
+            name = dir_entry.name
+            if (not name.endswith(_measurement_file_extensions)
+               or not dir_entry.is_file()):
+                continue
+            st = dir_entry.stat()
+            entry = self._entries.get(name)
+            if (entry is None or entry['size'] != st.st_size
+               or entry['mtime_ns'] != st.st_mtime_ns):
+                entry = {
+                    'timestamp': _get_filename_timestamp(name),
+                    'size': st.st_size,
+                    'mtime_ns': st.st_mtime_ns,
+                    'summary': self._read_summary(dir_entry.path),
+                    }
+                changed = True
+            entries[name] = entry
+
+        if len(entries) != len(self._entries):
+            changed = True
+
+        self._entries = entries
+        if changed:
+            self._sort()
+            self._save()
+        return changed
+
+    def _read_summary(self, filepath):
+        try:
+            with _open_measurement_file(filepath) as arq:
+                lines = _read_lines_until(arq, _read_data_labels)
+        except (OSError, EOFError):
+            return None
+
+        index = _index_header_lines(lines)
+        summary = {}
+        for key, (search_str_list, vtype) in self._summary_keys.items():
+            summary[key] = _find_value(index, search_str_list, vtype=vtype)
+        return summary
+
+    def _sort(self):
+        timestamps = [
+            self._entries[name]['timestamp'] for name in self._entries]
+        if any(timestamp is None for timestamp in timestamps):
+            self._filenames = sorted(self._entries)
         else:
-            main_mult = normal[n]
+            self._filenames = sorted(
+                self._entries,
+                key=lambda name: (self._entries[name]['timestamp'], name))
 
-        for i in range(nrpts):
-            for m in range(n+1, nr_harmonics):
-                residual_mult_normal[m, i] = (
-                    normal[m]/main_mult)*(pos[i]**(m - n))
-                residual_mult_skew[m, i] = (
-                    skew[m]/main_mult)*(pos[i]**(m - n))
+    def _get_index_path(self):
+        digest = _hashlib.sha1(self.directory.encode('utf-8')).hexdigest()
+        return _os.path.join(self.index_directory, digest + '.json')
 
-        return residual_mult_normal, residual_mult_skew
+    def _load(self):
+        try:
+            with open(self._get_index_path(), encoding='utf-8') as f:
+                index = _json.load(f)
+            if (index['version'] != self._version
+               or index['directory'] != self.directory):
+                return
+            self._entries = index['entries']
+            self._filenames = index['filenames']
+        except Exception:
+            self._entries = {}
+            self._filenames = []
+
+    def _save(self):
+        index = {
+            'version': self._version,
+            'directory': self.directory,
+            'entries': self._entries,
+            'filenames': self._filenames,
+            }
+        path = self._get_index_path()
+        tmp_path = path + '.tmp%d' % _os.getpid()
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                _json.dump(index, f)
+            _os.replace(tmp_path, path)
+        except OSError:
+            if _os.path.isfile(tmp_path):
+                _os.remove(tmp_path)
+
+
+def load_many(sources, database=None, read_curves=True, cache=None,
+              workers=None, curves_dtype=_np.float64):
+    """Load many measurements in a process pool.
+
+    Measurements from database are read in chunks of IDs, each with a
+    single connection (see MeasurementData.from_database). If a chunk
+    fails, its measurements are read one by one.
+
+    Args:
+        sources (list): file paths, or measurement IDs if database is given.
+        database (str): database file path.
+        read_curves (bool): read the raw curves while loading.
+        cache (MeasurementDataCache): cache of parsed measurement files.
+        workers (int): number of worker processes. If None, the number of
+            CPUs is used, or the measurements are loaded in this process if
+            there are fewer than _parallel_min_items of them. If 1, the
+            measurements are loaded in this process.
+        curves_dtype (dtype): storage type of the raw curves.
+
+    Returns:
+        data (list): MeasurementData objects in input order, None for the
+            items that failed.
+        errors (list): MeasurementDataError for the items that failed,
+            None for the others. Other errors raised while reading an item,
+            such as a missing file, are also reported as
+            MeasurementDataError.
+    """
+    sources = list(sources)
+    if workers is None:
+        if len(sources) < _parallel_min_items:
+            workers = 1
+        else:
+            workers = _os.cpu_count() or 1
+    workers = max(1, min(workers, len(sources)))
+
+    if database is not None:
+        chunksize = max(1, -(-len(sources)//workers))
+        chunksize = min(chunksize, _database_chunk_size)
+        args = [
+            (sources[i:i + chunksize], database, read_curves, curves_dtype)
+            for i in range(0, len(sources), chunksize)]
+        if workers == 1:
+            chunks = [_load_database_chunk(arg) for arg in args]
+        else:
+            with _futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                chunks = list(executor.map(_load_database_chunk, args))
+        results = [r for chunk in chunks for r in chunk]
+    else:
+        args = [
+            (source, read_curves, cache, curves_dtype) for source in sources]
+        if workers == 1:
+            results = [_load_one(arg) for arg in args]
+        else:
+            if cache is not None:
+                cache.trim()
+            chunksize = max(1, len(args)//(4*workers))
+            with _futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(
+                    executor.map(_load_one, args, chunksize=chunksize))
+            if cache is not None:
+                cache.trim()
+
+    data = [r if isinstance(r, MeasurementData) else None for r in results]
+    errors = [r if isinstance(r, MeasurementDataError) else None
+              for r in results]
+    return data, errors
+
+
+def _load_one(args):
+    filename, read_curves, cache, curves_dtype = args
+    try:
+        return MeasurementData(
+            filename=filename, read_curves=read_curves, cache=cache,
+            curves_dtype=curves_dtype)
+    except MeasurementDataError as e:
+        return e
+    except Exception as e:
+        message = (
+            'Failed to read measurement file: \n\n"%s" (%s)' % (filename, e))
+        return MeasurementDataError(message)
+
+
+def _load_database_chunk(args):
+    idns, database, read_curves, curves_dtype = args
+    try:
+        return MeasurementData.from_database(
+            database, idns, read_curves=read_curves,
+            curves_dtype=curves_dtype)
+    except Exception:
+        pass
+
+    results = []
+    for idn in idns:
+        try:
+            results.append(MeasurementData.from_database(
+                database, [idn], read_curves=read_curves,
+                curves_dtype=curves_dtype)[0])
+        except MeasurementDataError as e:
+            results.append(e)
+        except Exception as e:
+            message = (
+                'Failed to read measurement from database: \n\n'
+                'ID %s (%s)' % (idn, e))
+            results.append(MeasurementDataError(message))
+    return results
+
+
+def list_zip_files(filename):
+    """List the measurement files inside a zip archive.
+
+    Args:
+        filename (str): zip archive path.
+
+    Returns:
+        list of paths in the form archive.zip/member, which can be used as
+        MeasurementData file names.
+    """
+    with _zipfile.ZipFile(filename) as zf:
+        members = [
+            name for name in zf.namelist()
+            if name.endswith(_measurement_file_extensions)]
+    return [filename + '/' + member for member in members]
+
+
+def _split_zip_path(filename):
+    """Split a path inside a zip archive into archive and member names."""
+    if '.zip' not in filename.lower():
+        return None, None
+
+    parts = filename.replace('\\', '/').split('/')
+    for i in range(1, len(parts)):
+        archive = '/'.join(parts[:i])
+        if archive.lower().endswith('.zip') and _os.path.isfile(archive):
+            return archive, '/'.join(parts[i:])
+    return None, None
+
+
+def _stat_measurement_file(filename):
+    """Get the size and modification time of a measurement file.
+
+    Returns None if the file does not exist. For zip archive members the
+    uncompressed member size and the archive modification time are used.
+    """
+    archive, member = _split_zip_path(filename)
+    try:
+        if archive is not None:
+            with _zipfile.ZipFile(archive) as zf:
+                size = zf.getinfo(member).file_size
+            return size, _os.stat(archive).st_mtime_ns
+        elif _os.path.isfile(filename):
+            st = _os.stat(filename)
+            return st.st_size, st.st_mtime_ns
+    except (OSError, KeyError, _zipfile.BadZipFile):
+        pass
+    return None
+
+
+def _open_measurement_file(filename):
+    """Open a plain, compressed or zip archived measurement file as text."""
+    archive, member = _split_zip_path(filename)
+    if archive is not None:
+        with _zipfile.ZipFile(archive) as zf:
+            stream = zf.open(member)
+        return _io.TextIOWrapper(stream, encoding="latin1")
+
+    ext = _os.path.splitext(filename)[1].lower()
+    if ext in _compressed_file_openers:
+        return _compressed_file_openers[ext](
+            filename, 'rt', encoding="latin1")
+    return open(filename, encoding="latin1")
+
+
+def _get_filename_timestamp(filename):
+    """Get the timestamp in a measurement file name [s].
+
+    Returns None if the file name has no timestamp in the yymmdd_HHMMSS
+    format before the extension.
+    """
+    end = filename.find('.dat')
+    try:
+        return _time.mktime(_datetime.datetime.strptime(
+            filename[end-13:end], '%y%m%d_%H%M%S').timetuple())
+    except ValueError:
+        return None
+
+
+def _to_json(value):
+    if isinstance(value, _np.generic):
+        return value.item()
+    raise TypeError('Invalid cache value: %r' % value)
+
+
+def stack_multipoles(data):
+    """Stack the multipoles of several measurements.
+
+    Measurements with fewer harmonics are padded with zero multipoles.
+
+    Args:
+        data (list): list of MeasurementData objects.
+
+    Returns:
+        array with shape (number of measurements, number of harmonics,
+            number of multipoles columns).
+    """
+    multipoles = [d.multipoles for d in data]
+    if any(m is None for m in multipoles):
+        raise ValueError('Missing multipoles.')
+
+    nr_harmonics = max(m.shape[0] for m in multipoles)
+    nr_columns = max(m.shape[1] for m in multipoles)
+    stack = _np.zeros((len(multipoles), nr_harmonics, nr_columns))
+    for i, m in enumerate(multipoles):
+        stack[i, :m.shape[0], :m.shape[1]] = m
+    return stack
+
+
+def calc_integrated_field(multipoles, pos):
+    """Calculate the integrated field of one or several measurements.
+
+    Args:
+        multipoles (array): multipoles table, or stack of multipoles tables
+            with shape (number of measurements, number of harmonics,
+            number of multipoles columns).
+        pos (array): transversal position values [m].
+
+    Returns:
+        int_field_x (array): skew integrated field [T.m], with shape
+            (number of positions) or (number of measurements, number of
+            positions).
+        int_field_y (array): normal integrated field [T.m].
+    """
+    multipoles = _np.asarray(multipoles, dtype=_np.float64)
+    int_field_x = _evaluate_polynomials(multipoles[..., 3], pos)
+    int_field_y = _evaluate_polynomials(multipoles[..., 1], pos)
+    return int_field_x, int_field_y
+
+
+def calc_residuals(multipoles, main_harmonic, skew_magnet, pos):
+    """Calculate the residual field and multipoles of several measurements.
+
+    The multipoles above the main harmonic are normalized by the main
+    multipole, which is the skew multipole for skew magnets.
+
+    Args:
+        multipoles (array): multipoles table, or stack of multipoles tables
+            with shape (number of measurements, number of harmonics,
+            number of multipoles columns).
+        main_harmonic (int or array): main harmonic of each measurement.
+        skew_magnet (bool or array): skew magnet flag of each measurement.
+        pos (array): transversal position values [m].
+
+    Returns:
+        residual_normal (array): normal residual field, with shape
+            (number of positions) or (number of measurements, number of
+            positions).
+        residual_skew (array): skew residual field.
+        residual_mult_normal (array): normal residual multipoles, with shape
+            (number of harmonics, number of positions) or (number of
+            measurements, number of harmonics, number of positions).
+        residual_mult_skew (array): skew residual multipoles.
+    """
+    multipoles = _np.asarray(multipoles, dtype=_np.float64)
+    single = multipoles.ndim == 2
+    if single:
+        multipoles = multipoles[None, :, :]
+    pos = _np.asarray(pos, dtype=_np.float64)
+
+    nr_meas, nr_harmonics = multipoles.shape[:2]
+    n = _np.broadcast_to(_np.asarray(main_harmonic, dtype=int) - 1, nr_meas)
+    skew_magnet = _np.broadcast_to(
+        _np.asarray(skew_magnet, dtype=bool), nr_meas)
+
+    normal = multipoles[:, :, 1]
+    skew = multipoles[:, :, 3]
+    rows = _np.arange(nr_meas)
+    main_mult = _np.where(skew_magnet, skew[rows, n], normal[rows, n])
+
+    exponents = _np.arange(nr_harmonics)[None, :] - n[:, None]
+    mask = exponents > 0
+    powers = _power_table(pos, nr_harmonics)[_np.where(mask, exponents, 0)]
+
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        ratio_normal = normal/main_mult[:, None]
+        ratio_skew = skew/main_mult[:, None]
+
+    residual_mult_normal = _np.where(
+        mask[:, :, None], ratio_normal[:, :, None]*powers, 0.0)
+    residual_mult_skew = _np.where(
+        mask[:, :, None], ratio_skew[:, :, None]*powers, 0.0)
+
+    residual_normal = _np.zeros((nr_meas, len(pos)))
+    residual_skew = _np.zeros((nr_meas, len(pos)))
+    for m in range(nr_harmonics):
+        residual_normal += residual_mult_normal[:, m, :]
+        residual_skew += residual_mult_skew[:, m, :]
+
+    if single:
+        return (
+            residual_normal[0], residual_skew[0],
+            residual_mult_normal[0], residual_mult_skew[0])
+    return (
+        residual_normal, residual_skew,
+        residual_mult_normal, residual_mult_skew)
+
+
+def _evaluate_polynomials(coefficients, pos):
+    """Evaluate sum(coefficients[..., n]*pos**n) for all positions.
+
+    The powers of pos form a Vandermonde matrix, and the terms are added
+    in increasing order of n, as in a loop over the positions.
+
+    Args:
+        coefficients (array): polynomial coefficients, with shape
+            (..., number of terms).
+        pos (array): positions (1D).
+
+    Returns:
+        array with shape (..., number of positions).
+    """
+    coefficients = _np.asarray(coefficients, dtype=_np.float64)
+    pos = _np.asarray(pos, dtype=_np.float64)
+    powers = _power_table(pos, coefficients.shape[-1])
+    result = _np.zeros(coefficients.shape[:-1] + pos.shape)
+    for n in range(coefficients.shape[-1]):
+        result += coefficients[..., n, None]*powers[n]
+    return result
+
+
+def _power_table(pos, nr_powers):
+    """Get the table of powers pos**k for k in range(nr_powers).
+
+    The powers are computed with the C library pow, as the scalar
+    expression pos[i]**k, because the vectorized numpy power may differ
+    from it in the last bit.
+
+    Returns:
+        array with shape (nr_powers, number of positions).
+    """
+    pos_list = _np.asarray(pos, dtype=_np.float64).tolist()
+    table = [[p**k for p in pos_list] for k in range(nr_powers)]
+    return _np.array(table, dtype=_np.float64).reshape(
+        nr_powers, len(pos_list))
+
+
+def _get_column_value(description, row, name):
+    """Get a column value from a row, or None if the column is missing."""
+    if name in description:
+        return row[description.index(name)]
+    return None
+
+
+def _get_measurements_columns_str(cur, read_curves=True):
+    """Get the measurements table columns to select.
+
+    If the binary columns exist, the raw_curve text is only selected for
+    the rows without curves_bin.
+    """
+    cur.execute('PRAGMA TABLE_INFO(measurements)')
+    column_names = [ti[1] for ti in cur.fetchall()]
+
+    columns = []
+    for name in column_names:
+        if name in ('raw_curve', 'curves_bin'):
+            continue
+        columns.append('"{0:s}"'.format(name))
+
+    if read_curves:
+        columns.append(_get_raw_curve_columns_str(cur, column_names))
+
+    return ', '.join(columns)
+
+
+def _get_raw_curve_columns_str(cur, column_names=None):
+    """Get the raw curves columns to select."""
+    if column_names is None:
+        cur.execute('PRAGMA TABLE_INFO(measurements)')
+        column_names = [ti[1] for ti in cur.fetchall()]
+
+    if 'curves_bin' not in column_names:
+        return '"raw_curve"'
+
+    return (
+        '"curves_bin", CASE WHEN "curves_bin" IS NULL '
+        'THEN "raw_curve" END AS "raw_curve"')
+
+
+def _decode_raw_curves(lines, mult_factor, dtype=_np.float64):
+    """Decode the raw curves block into a matrix.
+
+    The first column (point number) of each line is dropped and the values
+    are scaled by mult_factor in float64 before conversion to dtype. All
+    lines must have the same number of values.
+    """
+    nrows = len(lines)
+    if nrows == 0:
+        return _np.zeros((0, 0), dtype=dtype)
+
+    rows = [line.split() for line in lines]
+    ncols = len(rows[0])
+    if any(len(row) != ncols for row in rows):
+        raise MeasurementDataError('Invalid raw data block.')
+
+    try:
+        values = _np.array(
+            [value for row in rows for value in row], dtype=_np.float64)
+    except ValueError:
+        raise MeasurementDataError('Invalid raw data block.')
+
+    curves = values.reshape(nrows, ncols)[:, 1:]
+    curves *= mult_factor
+    return curves.astype(dtype, copy=False)
+
+
+def _read_lines_until(arq, search_str_list):
+    """Read file lines up to the first line containing a search string."""
+    lines = []
+    for line in arq:
+        line = line.rstrip('\r\n')
+        lines.append(line)
+        if any(search_str in line for search_str in search_str_list):
+            break
+    return lines
+
+
+def _index_header_lines(lines):
+    """Map each header key to its value string in a single pass.
 
+    The scan stops at the raw data block, so the size of the index does not
+    depend on the number of integration points or turns.
+    """
+    index = {}
+    for line in lines:
+        if any(label in line for label in _raw_data_labels):
+            break
+        sline = line.split('\t')
+        key = sline[0].strip()
+        if key not in index:
+            index[key] = sline[1] if len(sline) > 1 else None
+    return index
 
-def _find_value(lines, search_str_list, vtype=str):
+
+def _find_value(index, search_str_list, vtype=str):
     if isinstance(search_str_list, str):
         search_str_list = [search_str_list]
 
+    found = False
     for search_str in search_str_list:
-        index = _search_in_file_lines(lines, search_str)
-        if index is not None:
+        if search_str in index:
+            value = index[search_str]
+            found = True
+        else:
+            for key in index:
+                if search_str in key:
+                    value = index[key]
+                    found = True
+                    break
+        if found:
             break
 
-    if index is not None:
-        try:
-            value = lines[index].split('\t')[1]
-            value = vtype(value)
-            return value
-        except Exception:
-            return None
-    else:
+    if not found or value is None:
+        return None
+
+    try:
+        return vtype(value)
+    except Exception:
         return None
 
 
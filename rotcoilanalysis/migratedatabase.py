@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""Command to migrate a measurements database to the current format."""
+
+import sys as _sys
+import argparse as _argparse
+
+from . import database as _database
+
+
+def run(args=None):
+    """Run the database migration command."""
+    parser = _argparse.ArgumentParser(
+        description=(
+            'Backfill the binary multipoles and raw curves columns and the '
+            'derived results table of a rotating coil measurements '
+            'database, and optionally create its full-text index. '
+            'Older versions of the graphical interface cannot browse a '
+            'migrated database.'))
+    parser.add_argument('database', help='database file path')
+    parser.add_argument(
+        '--float32', action='store_true',
+        help='store the raw curves in float32')
+    parser.add_argument(
+        '--no-compress', action='store_true',
+        help='do not compress the arrays')
+    parser.add_argument(
+        '--no-derived-results', action='store_true',
+        help='do not create or update the derived results table')
+    parser.add_argument(
+        '--text-index', action='store_true',
+        help=(
+            'create the full-text index of the measurements table; its '
+            'tables also break the database browser of older versions'))
+    options = parser.parse_args(args)
+
+    dtype = 'float32' if options.float32 else 'float64'
+    try:
+        converted, failed = _database.migrate_database(
+            options.database, dtype=dtype,
+            compress=not options.no_compress)
+        if not options.no_derived_results:
+            updated, failed_results = (
+                _database.update_derived_results(options.database))
+        if options.text_index:
+            _database.create_text_index(options.database)
+    except Exception as e:
+        _sys.stderr.write('Failed to migrate database: %s\n' % str(e))
+        return 1
+
+    print('Converted rows: %i' % converted)
+    if len(failed) > 0:
+        print('Rows kept as text only: %s' % ', '.join(
+            str(idn) for idn in failed))
+
+    if not options.no_derived_results:
+        print('Updated derived results: %i' % updated)
+        if len(failed_results) > 0:
+            print('Rows without derived results: %s' % ', '.join(
+                str(idn) for idn in failed_results))
+    return 0
+
+
+if __name__ == '__main__':
+    _sys.exit(run())
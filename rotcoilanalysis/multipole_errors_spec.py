@@ -1,7 +1,14 @@
 """Multipole errors specification."""
 
+import os as _os
+import hashlib as _hashlib
+import collections as _collections
 import numpy as _np
-import random as _random
+
+
+_nr_samples = 5000
+_gauss_trunc = 1
+_envelope_modes = ('sampled', 'analytic')
 
 
 def _get_multipole_errors_spec():
@@ -337,10 +344,187 @@ def _get_magnet_multipole_errors_spec(magnet_name):
         return magnet_spec
 
 
+class SpecEnvelopeCache(object):
+    """Cache of residual field limits.
+
+    Entries are kept in memory and the least recently used ones are
+    removed when there are more than max_entries. If a directory is given,
+    the entries are also saved to it, so they are kept between sessions.
+    """
+
+    _version = 1
+
+    def __init__(self, max_entries=128, directory=None):
+        """Initialize variables.
+
+        Args:
+            max_entries (int): maximum number of entries.
+            directory (str): cache directory path. If None, the entries are
+                only kept in memory.
+        """
+        self.max_entries = max_entries
+        self.directory = directory
+        self._entries = _collections.OrderedDict()
+        if self.directory is not None and not _os.path.isdir(self.directory):
+            _os.makedirs(self.directory)
+
+    def get(self, key):
+        """Get the cached limits (tuple of arrays), or None if not found."""
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            return value
+
+        value = self._load(key)
+        if value is not None:
+            self._store(key, value)
+        return value
+
+    def set(self, key, value):
+        """Add limits (tuple of arrays) to the cache."""
+        self._store(key, value)
+        self._save(key, value)
+
+    def clear(self):
+        """Remove all cache entries."""
+        self._entries.clear()
+        for path, _ in self._get_files():
+            try:
+                _os.remove(path)
+            except OSError:
+                pass
+
+    def _store(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _get_entry_path(self, key):
+        digest = _hashlib.sha1(
+            repr((self._version, ) + key).encode('utf-8')).hexdigest()
+        return _os.path.join(self.directory, digest + '.npz')
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+
+        path = self._get_entry_path(key)
+        try:
+            with _np.load(path, allow_pickle=False) as entry:
+                if str(entry['key']) != repr(key):
+                    return None
+                value = (entry['sys'], entry['min'], entry['max'])
+            _os.utime(path)
+        except Exception:
+            return None
+        return value
+
+    def _save(self, key, value):
+        if self.directory is None:
+            return
+
+        path = self._get_entry_path(key)
+        tmp_path = path + '.tmp%d' % _os.getpid()
+        try:
+            with open(tmp_path, 'wb') as f:
+                _np.savez(
+                    f, key=_np.array(repr(key)),
+                    sys=value[0], min=value[1], max=value[2])
+            _os.replace(tmp_path, path)
+        except OSError:
+            if _os.path.isfile(tmp_path):
+                _os.remove(tmp_path)
+            return
+
+        files = self._get_files()
+        files.sort(key=lambda f: f[1])
+        for path, _ in files[:max(len(files) - self.max_entries, 0)]:
+            try:
+                _os.remove(path)
+            except OSError:
+                pass
+
+    def _get_files(self):
+        if self.directory is None:
+            return []
+
+        files = []
+        for name in _os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = _os.path.join(self.directory, name)
+                try:
+                    files.append((path, _os.stat(path).st_mtime))
+                except OSError:
+                    pass
+        return files
+
+
+_envelope_cache = SpecEnvelopeCache()
+
+
+def set_envelope_cache(cache):
+    """Set the cache of residual field limits.
+
+    Args:
+        cache (SpecEnvelopeCache): new cache. If None, the limits are
+            computed on every call.
+    """
+    global _envelope_cache
+    _envelope_cache = cache
+
+
+def _get_digest(*arrays):
+    digest = _hashlib.sha1()
+    for array in arrays:
+        array = _np.ascontiguousarray(array, dtype=float)
+        digest.update(repr(array.shape).encode('utf-8'))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def _cached_residual_field(component, r0, x, n, sys_monomials,
+                           sys_relative_multipoles_at_r0, rms_monomials,
+                           rms_relative_multipoles_at_r0, seed=None,
+                           mode='sampled'):
+    """Get the residual field limits from the cache or compute them.
+
+    The cache key is made of the specification values, r0, the x grid,
+    the component, the mode and the seed of the sampled mode. Sampled
+    limits without a seed are not cached, so they still change on each
+    call.
+    """
+    if _envelope_cache is None or (mode == 'sampled' and seed is None):
+        return _residual_field(
+            r0, x, n, sys_monomials, sys_relative_multipoles_at_r0,
+            rms_monomials, rms_relative_multipoles_at_r0,
+            seed=seed, mode=mode)
+
+    spec_digest = _get_digest(
+        n, sys_monomials, sys_relative_multipoles_at_r0,
+        rms_monomials, rms_relative_multipoles_at_r0)
+    key = (
+        spec_digest, float(r0), _get_digest(x), component, mode,
+        seed if mode == 'sampled' else None)
+
+    value = _envelope_cache.get(key)
+    if value is None:
+        value = _residual_field(
+            r0, x, n, sys_monomials, sys_relative_multipoles_at_r0,
+            rms_monomials, rms_relative_multipoles_at_r0,
+            seed=seed, mode=mode)
+        _envelope_cache.set(key, value)
+
+    return tuple(_np.array(v) for v in value)
+
+
 def _residual_field(r0, x, n, sys_monomials, sys_relative_multipoles_at_r0,
-                    rms_monomials, rms_relative_multipoles_at_r0):
-    nr_samples = 5000
-    gauss_trunc = 1
+                    rms_monomials, rms_relative_multipoles_at_r0, seed=None,
+                    mode='sampled'):
+    if mode not in _envelope_modes:
+        raise ValueError('Invalid envelope mode: %s' % mode)
+
+    x = _np.asarray(x, dtype=float)
 
     # Systematic residual
     sys_residue = _np.zeros(len(x))
@@ -349,48 +533,59 @@ def _residual_field(r0, x, n, sys_monomials, sys_relative_multipoles_at_r0,
             sys_residue +
             1*sys_relative_multipoles_at_r0[i]*(x/r0)**(sys_monomials[i]-n))
 
-    size = len(rms_relative_multipoles_at_r0)*nr_samples
-    rnd_grid = _np.array([])
+    rms_relative_multipoles_at_r0 = _np.asarray(
+        rms_relative_multipoles_at_r0, dtype=float)
+    exponents = _np.asarray(rms_monomials, dtype=float) - n
+    monomials = (x[None, :]/r0)**exponents[:, None]
 
-    # Making the random normal distribution
-    while (len(rnd_grid) < size):
-        randomgauss = _random.gauss(0, 1)
-        if (abs(randomgauss) > gauss_trunc):
-            randomgauss = []
-        rnd_grid = _np.append(rnd_grid,  randomgauss)
-    rnd_grid = rnd_grid.reshape(nr_samples, int(size/nr_samples))
+    if mode == 'analytic':
+        # Largest deviation with each coefficient within the truncation
+        rms_limit = _gauss_trunc*_np.abs(
+            rms_relative_multipoles_at_r0[:, None]*monomials).sum(axis=0)
+        return sys_residue, sys_residue + rms_limit, sys_residue - rms_limit
 
-    max_residue = sys_residue
-    min_residue = sys_residue
+    # Random relative multipoles, one row for each sample
+    rng = _np.random.default_rng(seed)
+    nr_rms = len(rms_relative_multipoles_at_r0)
+    rnd_grid = _truncated_normal(
+        rng, _nr_samples*nr_rms, _gauss_trunc).reshape(_nr_samples, nr_rms)
+    rnd_relative_rms = rnd_grid*rms_relative_multipoles_at_r0
 
-    # Use rows of random grid for calculate the relative rms and residual field
-    for j in range(nr_samples):
-        rnd_vector = rnd_grid[j, :]
-        rnd_relative_rms = (rms_relative_multipoles_at_r0)*rnd_vector
-        rms_residue = 0
-        for i in range(len(rms_monomials)):
-            rms_residue = (
-                rms_residue +
-                1*rnd_relative_rms[i]*(x/r0)**(rms_monomials[i]-n))
+    # Residual field of all samples
+    residue_field = sys_residue + rnd_relative_rms.dot(monomials)
 
-        residue_field = sys_residue + rms_residue
+    max_residue = _np.maximum(residue_field.max(axis=0), sys_residue)
+    min_residue = _np.minimum(residue_field.min(axis=0), sys_residue)
 
-        # Maximum residual values
-        max_residue = _np.maximum(residue_field,  max_residue)
+    return sys_residue,  max_residue,  min_residue
 
-        # Minimum residual values
-        min_residue = _np.minimum(residue_field,  min_residue)
 
-    return sys_residue,  max_residue,  min_residue
+def _truncated_normal(rng, size, trunc):
+    """Draw standard normal values truncated to [-trunc, trunc]."""
+    samples = _np.zeros(0)
+    while len(samples) < size:
+        missing = size - len(samples)
+        draw = rng.standard_normal(2*missing + 16)
+        samples = _np.concatenate([samples, draw[_np.abs(draw) <= trunc]])
+    return samples[:size]
 
 
-def normal_residual_field(r0, x, magnet_name):
+def normal_residual_field(r0, x, magnet_name, seed=None, mode='sampled'):
     """Get normal residual field limits.
 
+    The random multipoles are truncated to one standard deviation. In the
+    sampled mode the limits are the envelope of Monte Carlo samples, and in
+    the analytic mode they are the exact envelope, the systematic residue
+    plus or minus the sum of the absolute random terms.
+
     Args:
         r0 (float): reference radius [m].
         x (array): transversal position values [m].
         magnet_name (str): magnet name.
+        seed (int): random generator seed of the sampled mode. If None,
+            the limits change slightly on each call and are not cached.
+            Other limits are cached (see set_envelope_cache).
+        mode (str): 'sampled' or 'analytic'.
 
     Returns:
         sys_residue (array): systematic error values [T].
@@ -408,20 +603,29 @@ def normal_residual_field(r0, x, magnet_name):
         normal_sys_multipoles = multipole_errors['normal_sys_multipoles']
         normal_rms_monomials = multipole_errors['normal_rms_monomials']
         normal_rms_multipoles = multipole_errors['normal_rms_multipoles']
-        sys_residue,  max_residue,  min_residue = _residual_field(
-            r0, x, n, normal_sys_monomials, normal_sys_multipoles,
-            normal_rms_monomials, normal_rms_multipoles)
+        sys_residue,  max_residue,  min_residue = _cached_residual_field(
+            'normal', r0, x, n, normal_sys_monomials, normal_sys_multipoles,
+            normal_rms_monomials, normal_rms_multipoles, seed=seed, mode=mode)
 
         return sys_residue,  min_residue, max_residue
 
 
-def skew_residual_field(r0, x, magnet_name):
+def skew_residual_field(r0, x, magnet_name, seed=None, mode='sampled'):
     """Get skew residual field limits.
 
+    The random multipoles are truncated to one standard deviation. In the
+    sampled mode the limits are the envelope of Monte Carlo samples, and in
+    the analytic mode they are the exact envelope, the systematic residue
+    plus or minus the sum of the absolute random terms.
+
     Args:
         r0 (float): reference radius [m].
         x (array): transversal position values [m].
         magnet_name (str): magnet name.
+        seed (int): random generator seed of the sampled mode. If None,
+            the limits change slightly on each call and are not cached.
+            Other limits are cached (see set_envelope_cache).
+        mode (str): 'sampled' or 'analytic'.
 
     Returns:
         sys_residue (array): systematic error values [T].
@@ -439,9 +643,9 @@ def skew_residual_field(r0, x, magnet_name):
         skew_sys_multipoles = multipole_errors['skew_sys_multipoles']
         skew_rms_monomials = multipole_errors['skew_rms_monomials']
         skew_rms_multipoles = multipole_errors['skew_rms_multipoles']
-        sys_residue,  max_residue,  min_residue = _residual_field(
-            r0, x, n, skew_sys_monomials, skew_sys_multipoles,
-            skew_rms_monomials, skew_rms_multipoles)
+        sys_residue,  max_residue,  min_residue = _cached_residual_field(
+            'skew', r0, x, n, skew_sys_monomials, skew_sys_multipoles,
+            skew_rms_monomials, skew_rms_multipoles, seed=seed, mode=mode)
 
         return sys_residue,  min_residue, max_residue
 
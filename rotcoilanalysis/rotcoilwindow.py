@@ -9,7 +9,6 @@ import sys as _sys
 import locale as _locale
 import matplotlib.ticker as _mtick
 import matplotlib.gridspec as _gridspec
-import sqlite3 as _sqlite3
 import importlib as _importlib
 import traceback as _traceback
 from PyQt5.QtWidgets import (
@@ -26,6 +25,7 @@ from PyQt5.QtGui import QPixmap as _QPixmap
 from PyQt5.QtCore import Qt as _Qt
 from PyQt5 import uic as _uic
 
+from . import database as _database
 from . import measurement_data as _measurement_data
 from . import pdf_report as _pdf_report
 from . import utils as _utils
@@ -63,10 +63,25 @@ _addlimy = 0.25
 _whfactor = 0.7
 _figure_width = 300
 _report_figsize = [685, 480]
+# Fixed seed of the sampled specification limits, so they are cached and
+# do not change between plots of the same magnet.
+_spec_seed = 0
+# Set ROTCOILANALYSIS_CURVES_DTYPE=float32 to keep the raw curves in single
+# precision and halve their memory use.
+_curves_dtype = {
+    'float32': _np.float32,
+    'float64': _np.float64,
+}.get(_os.environ.get('ROTCOILANALYSIS_CURVES_DTYPE'), _np.float64)
 
 # _default_dir = _os.path.expanduser('~')
 _default_dir = 'C:\\Arq\\Work_At_LNLS\\eclipse-workspace\\rotating-coil-software_lnls477\\rotating_coil'
 _basepath = _os.path.dirname(_os.path.abspath(__file__))
+_cache_dir = _os.path.join(
+    _os.path.expanduser('~'), '.rotcoilanalysis', 'cache')
+_index_dir = _os.path.join(
+    _os.path.expanduser('~'), '.rotcoilanalysis', 'index')
+_spec_cache_dir = _os.path.join(
+    _os.path.expanduser('~'), '.rotcoilanalysis', 'spec')
 
 
 class MainWindow(_QMainWindow):
@@ -92,6 +107,7 @@ class MainWindow(_QMainWindow):
         self.ui.cb_files_wg.setLayout(_layout)
 
         self.directory = None
+        self.files_index = None
         self.preview_doc = None
         self.database = None
         self.files = []
@@ -102,6 +118,10 @@ class MainWindow(_QMainWindow):
         self.normal_color = 'blue'
         self.skew_color = 'red'
         self.figsize = None
+        self.cache = _measurement_data.MeasurementDataCache(_cache_dir)
+        _multipole_errors_spec.set_envelope_cache(
+            _multipole_errors_spec.SpecEnvelopeCache(
+                directory=_spec_cache_dir))
 
         self._add_plot_widgets()
         self._connect_widgets()
@@ -318,7 +338,10 @@ class MainWindow(_QMainWindow):
     def load_files(self):
         """Load input files and sorts by date and time."""
         files = _QFileDialog.getOpenFileNames(
-            directory=_default_dir, filter="Measurement files (*.dat)")
+            directory=_default_dir,
+            filter=(
+                "Measurement files "
+                "(*.dat *.dat.gz *.dat.xz *.dat.bz2 *.zip)"))
 
         if isinstance(files, tuple):
             files = files[0]
@@ -327,6 +350,18 @@ class MainWindow(_QMainWindow):
             return
 
         try:
+            expanded_files = []
+            for f in files:
+                if f.lower().endswith('.zip'):
+                    expanded_files.extend(
+                        _measurement_data.list_zip_files(f))
+                else:
+                    expanded_files.append(f)
+            files = expanded_files
+
+            if len(files) == 0:
+                return
+
             self.files = self._sort_files(files)
             self.directory = _os.path.split(self.files[0])[0]
             self.ui.files_directory.setText(self.directory)
@@ -334,9 +369,7 @@ class MainWindow(_QMainWindow):
 
             self.ui.files_input.clear()
             for i in range(len(self.files)):
-                item = _QTableWidgetItem()
-                self.ui.files_input.setItem(i, 0, item)
-                item.setText(_os.path.split(self.files[i])[1])
+                self._set_file_item(self.ui.files_input, i, self.files[i])
 
             self.ui.files_input_count.setText(str(len(self.files)))
         except Exception:
@@ -344,25 +377,26 @@ class MainWindow(_QMainWindow):
             _QMessageBox.critical(
                 self, 'Failure', 'Failed to load files.', _QMessageBox.Ok)
 
+    def _set_file_item(self, table, row, filepath):
+        item = _QTableWidgetItem()
+        table.setItem(row, 0, item)
+        item.setText(_os.path.split(filepath)[1])
+        item.setToolTip(filepath)
+        item.setData(_Qt.UserRole, filepath)
+
     def _sort_files(self, files):
         try:
-            index = _np.array([])
-            for i in range(len(files)):
-                timestamp = files[i][
-                    files[i].find('.dat')-13:files[i].find('.dat')]
-                time_sec = _time.mktime(_datetime.datetime.strptime(
-                    timestamp, '%y%m%d_%H%M%S').timetuple())
-                index = _np.append(index, time_sec)
-            index = index.argsort()
-
-            sorted_files = _np.array([])
-            for i in range(len(files)):
-                sorted_files = _np.append(sorted_files, files[index[i]])
+            time_sec = []
+            for f in files:
+                timestamp = f[f.find('.dat')-13:f.find('.dat')]
+                time_sec.append(_time.mktime(_datetime.datetime.strptime(
+                    timestamp, '%y%m%d_%H%M%S').timetuple()))
+            index = _np.argsort(time_sec)
+            sorted_files = [files[i] for i in index]
         except Exception:
             _traceback.print_exc(file=_sys.stdout)
-            sorted_files = _np.array(files)
+            sorted_files = list(files)
 
-        sorted_files = [f for f in sorted_files]
         return sorted_files
 
     def load_database(self):
@@ -406,9 +440,9 @@ class MainWindow(_QMainWindow):
         try:
             if _selected_items != []:
                 for item in _selected_items:
-                    filename = item.text()
-                    if filename not in self.files_uploaded:
-                        self.files_uploaded.append(filename)
+                    filepath = item.data(_Qt.UserRole)
+                    if filepath not in self.files_uploaded:
+                        self.files_uploaded.append(filepath)
 
                 self.ui.files_output_count.setText(
                     str(len(self.files_uploaded)))
@@ -416,9 +450,8 @@ class MainWindow(_QMainWindow):
                 self.ui.files_output.clear()
 
                 for i in range(len(self.files_uploaded)):
-                    item = _QTableWidgetItem()
-                    self.ui.files_output.setItem(i, 0, item)
-                    item.setText(self.files_uploaded[i])
+                    self._set_file_item(
+                        self.ui.files_output, i, self.files_uploaded[i])
         except Exception:
             _traceback.print_exc(file=_sys.stdout)
             _QMessageBox.critical(
@@ -434,17 +467,32 @@ class MainWindow(_QMainWindow):
             idx = self.database_tab.currentIndex()
             selected_idns = self.database_tab.tables[idx].getSelectedIDs()
 
+            uploaded_idns = set(self.idns)
             for idn in selected_idns:
-                if idn not in self.idns:
+                if idn not in uploaded_idns:
                     self.idns.append(idn)
+                    uploaded_idns.add(idn)
 
-            con = _sqlite3.connect(self.database)
+            names = {}
+            con = _database.get_connection(self.database)
             cur = con.cursor()
-            self.database_uploaded = []
-            for idn in self.idns:
-                cur.execute('SELECT * FROM measurements WHERE id = ?', (idn,))
-                m = cur.fetchone()
-                self.database_uploaded.append("ID %i: %s" % (m[0], m[2]))
+            chunk_size = _measurement_data._database_chunk_size
+            for i in range(0, len(self.idns), chunk_size):
+                chunk = self.idns[i:i + chunk_size]
+                cmd = 'SELECT id, name FROM measurements WHERE id IN ({0})'
+                cur.execute(cmd.format(', '.join('?'*len(chunk))), chunk)
+                names.update(cur.fetchall())
+
+            missing_idns = [idn for idn in self.idns if idn not in names]
+            if len(missing_idns) > 0:
+                self.idns = [idn for idn in self.idns if idn in names]
+                message = 'Measurements not found in database: %s' % (
+                    ', '.join(str(idn) for idn in missing_idns))
+                _QMessageBox.warning(
+                    self, 'Warning', message, _QMessageBox.Ignore)
+
+            self.database_uploaded = [
+                "ID %i: %s" % (idn, names[idn]) for idn in self.idns]
 
             self.ui.database_output_count.setText(
                 str(len(self.database_uploaded)))
@@ -467,19 +515,29 @@ class MainWindow(_QMainWindow):
             return
 
         try:
-            files = []
-            for f in _os.listdir(self.directory):
-                if f.endswith('.dat'):
-                    files.append(_os.path.join(self.directory, f))
+            if (self.files_index is None or
+               self.files_index.directory !=
+               _os.path.abspath(self.directory)):
+                self.files_index = _measurement_data.MeasurementFileIndex(
+                    self.directory, _index_dir)
+            self.files_index.update()
+
+            files = [
+                _os.path.join(self.directory, f)
+                for f in self.files_index.filenames]
+            if files == self.files:
+                return
 
-            self.files = self._sort_files(files)
-            self.ui.files_input.setRowCount(len(self.files))
+            if files[:len(self.files)] == self.files:
+                start = len(self.files)
+            else:
+                start = 0
+                self.ui.files_input.clear()
 
-            self.ui.files_input.clear()
-            for i in range(len(self.files)):
-                item = _QTableWidgetItem()
-                self.ui.files_input.setItem(i, 0, item)
-                item.setText(_os.path.split(self.files[i])[1])
+            self.files = files
+            self.ui.files_input.setRowCount(len(self.files))
+            for i in range(start, len(self.files)):
+                self._set_file_item(self.ui.files_input, i, self.files[i])
 
             self.ui.files_input_count.setText(str(len(self.files)))
         except Exception:
@@ -497,11 +555,7 @@ class MainWindow(_QMainWindow):
             self.blockSignals(True)
             _QApplication.setOverrideCursor(_Qt.WaitCursor)
 
-            idx = self.database_tab.currentIndex()
-            self.database_tab.clearDatabase()
-            self.database_tab.loadDatabase(database_filename=self.database)
-            self.database_tab.scrollDownTables()
-            self.database_tab.setCurrentIndex(idx)
+            self.database_tab.refreshDatabase()
 
             self.blockSignals(False)
             _QApplication.restoreOverrideCursor()
@@ -550,7 +604,7 @@ class MainWindow(_QMainWindow):
             for idx in range(self.ui.files_output.rowCount()):
                 if self.ui.files_output.item(idx, 0):
                     self.files_uploaded.append(
-                        self.ui.files_output.item(idx, 0).text())
+                        self.ui.files_output.item(idx, 0).data(_Qt.UserRole))
 
             self.ui.files_output_count.setText(str(len(self.files_uploaded)))
         except Exception:
@@ -625,21 +679,17 @@ class MainWindow(_QMainWindow):
             return
 
         try:
-            for filename in self.files_uploaded:
-                md = self._get_measurement_data_file(filename=filename)
-                if md is not None:
-                    data = _np.append(data, md)
+            for md in self._load_measurement_data(self.files_uploaded):
+                data = _np.append(data, md)
 
             if len(data) > 0:
                 self.data = self._sort_data(data)
-                self.files_uploaded = [
-                    _os.path.split(d.filename)[-1] for d in self.data]
+                self.files_uploaded = [d.filename for d in self.data]
 
                 self.ui.files_output.clear()
                 for i in range(len(self.files_uploaded)):
-                    item = _QTableWidgetItem()
-                    self.ui.files_output.setItem(i, 0, item)
-                    item.setText(self.files_uploaded[i])
+                    self._set_file_item(
+                        self.ui.files_output, i, self.files_uploaded[i])
 
                 self.columns_names = self.data[0].columns_names
                 self.reference_radius = self.data[0].normalization_radius
@@ -668,10 +718,9 @@ class MainWindow(_QMainWindow):
 
         data = _np.array([])
         try:
-            for idn in self.idns:
-                md = self._get_measurement_data_database(idn=idn)
-                if md is not None:
-                    data = _np.append(data, md)
+            for md in self._load_measurement_data(
+                    self.idns, database=self.database):
+                data = _np.append(data, md)
 
             if len(data) > 0:
                 self.data = self._sort_data(data)
@@ -714,25 +763,18 @@ class MainWindow(_QMainWindow):
             sort_data = _np.append(sort_data, data[i])
         return sort_data
 
-    def _get_measurement_data_file(self, filename):
-        try:
-            filepath = _os.path.join(self.directory, filename)
-            df = _measurement_data.MeasurementData(filepath)
-            return df
-        except _measurement_data.MeasurementDataError as e:
-            _QMessageBox.warning(
-                self, 'Warning', e.message, _QMessageBox.Ignore)
-            return None
+    def _load_measurement_data(self, sources, database=None):
+        data, errors = _measurement_data.load_many(
+            sources, database=database, read_curves=False,
+            cache=self.cache if database is None else None,
+            curves_dtype=_curves_dtype)
 
-    def _get_measurement_data_database(self, idn):
-        try:
-            df = _measurement_data.MeasurementData(
-                idn=idn, database=self.database)
-            return df
-        except _measurement_data.MeasurementDataError as e:
-            _QMessageBox.warning(
-                self, 'Warning', e.message, _QMessageBox.Ignore)
-            return None
+        for error in errors:
+            if error is not None:
+                _QMessageBox.warning(
+                    self, 'Warning', error.message, _QMessageBox.Ignore)
+
+        return [md for md in data if md is not None]
 
     def _set_file_id(self):
         main = []
@@ -1160,8 +1202,11 @@ class MainWindow(_QMainWindow):
 
             for i in index_list:
                 if self.ui.cb_avg_2.currentIndex() == 0:
-                    self.data[i].curves_df.mean(axis=1).plot(
-                        legend=False, yerr=self.data[i].curves_df.std(axis=1),
+                    index = self.data[i].curves_df.index
+                    avg = _pd.Series(self.data[i].raw_data_avg, index=index)
+                    std = _pd.Series(self.data[i].raw_data_std, index=index)
+                    avg.plot(
+                        legend=False, yerr=std,
                         ax=self.ui.wt_multipoles.canvas.ax)
                     if len(index_list) > 1:
                         self.ui.wt_multipoles.canvas.ax.set_title(
@@ -1270,14 +1315,8 @@ class MainWindow(_QMainWindow):
                     name = name_split[0]
                 magnet_names.append(name.strip())
 
-            residual_normal = []
-            residual_skew = []
-            for i in index_list:
-                n, s = self.data[i].calc_residual_field(xpos)
-                residual_normal.append(n)
-                residual_skew.append(s)
-            residual_normal = _np.array(residual_normal)
-            residual_skew = _np.array(residual_skew)
+            residual_normal, residual_skew, _, _ = self._calc_residuals(
+                index_list, xpos)
 
             residual_field_normal_df = _pd.DataFrame(
                 residual_normal.T, index=index, columns=columns)
@@ -1326,16 +1365,20 @@ class MainWindow(_QMainWindow):
                         legend=legend, marker='o', color=color,
                         ax=self.ui.wt_residual.canvas.ax)
 
-            if (self.ui.cb_spec_on.currentIndex() == 0 and
+            spec_index = self.ui.cb_spec_on.currentIndex()
+            if (spec_index != 1 and
                all(x == magnet_names[0] for x in magnet_names)):
+                mode = 'analytic' if spec_index == 2 else 'sampled'
                 if self.ui.rb_norm_2.isChecked() == 1:
                     sys_residue, min_residue, max_residue = (
                         _multipole_errors_spec.normal_residual_field(
-                            rref, xpos, magnet_names[0]))
+                            rref, xpos, magnet_names[0],
+                            seed=_spec_seed, mode=mode))
                 else:
                     sys_residue, min_residue, max_residue = (
                         _multipole_errors_spec.skew_residual_field(
-                            rref, xpos, magnet_names[0]))
+                            rref, xpos, magnet_names[0],
+                            seed=_spec_seed, mode=mode))
 
                 if sys_residue is not None:
                     residue = _pd.DataFrame()
@@ -1382,6 +1425,14 @@ class MainWindow(_QMainWindow):
                 'Failed to plot residual field.',
                 _QMessageBox.Ok)
 
+    def _calc_residuals(self, index_list, xpos):
+        data = [self.data[i] for i in index_list]
+        return _measurement_data.calc_residuals(
+            _measurement_data.stack_multipoles(data),
+            [d.main_harmonic for d in data],
+            [d.skew_magnet for d in data],
+            xpos)
+
     def _plot_integrated_field(self, all_files=False, figsize=None, idx=None):
         self.ui.wt_integrated_field.canvas.ax.clear()
 
@@ -1447,14 +1498,12 @@ class MainWindow(_QMainWindow):
                     name = name_split[0]
                 magnet_names.append(name.strip())
 
-            integrated_field_x = []
-            integrated_field_y = []
-            for i in index_list:
-                ibx, iby = self.data[i].calc_integrated_field(xpos)
-                integrated_field_x.append(ibx)
-                integrated_field_y.append(iby)
-            integrated_field_x = _np.array(integrated_field_x)*1e6 + offsetx
-            integrated_field_y = _np.array(integrated_field_y)*1e6 + offsety
+            multipoles = _measurement_data.stack_multipoles(
+                [self.data[i] for i in index_list])
+            integrated_field_x, integrated_field_y = (
+                _measurement_data.calc_integrated_field(multipoles, xpos))
+            integrated_field_x = integrated_field_x*1e6 + offsetx
+            integrated_field_y = integrated_field_y*1e6 + offsety
 
             integrated_field_x_df = _pd.DataFrame(
                 integrated_field_x.T, index=index, columns=columns)
@@ -1562,19 +1611,9 @@ class MainWindow(_QMainWindow):
 
             zeros = _np.zeros(xnpts)
 
-            max_harmonic = 15
-
-            residual_mult_normal = _np.zeros(
-                [max_harmonic, xnpts, len(index_list)])
-            residual_mult_skew = _np.zeros(
-                [max_harmonic, xnpts, len(index_list)])
-
-            count = 0
-            for i in index_list:
-                normal, skew = self.data[i].calc_residual_multipoles(xpos)
-                residual_mult_normal[:, :, count] = normal
-                residual_mult_skew[:, :, count] = skew
-                count = count + 1
+            _, _, normal, skew = self._calc_residuals(index_list, xpos)
+            residual_mult_normal = _np.moveaxis(normal, 0, -1)
+            residual_mult_skew = _np.moveaxis(skew, 0, -1)
 
             if self.ui.rb_norm_2.isChecked() == 1:
                 residual_multipoles = residual_mult_normal
@@ -1667,7 +1706,7 @@ class MainWindow(_QMainWindow):
 
     def enable_reference_radius(self):
         """Enable reference radius spin box."""
-        if self.ui.cb_spec_on.currentIndex() == 0:
+        if self.ui.cb_spec_on.currentIndex() != 1:
             self.ui.ds_reference_radius.setEnabled(True)
         else:
             self.ui.ds_reference_radius.setEnabled(False)
@@ -17,7 +17,9 @@ setup(
     ],
     entry_points={
         'console_scripts': [
-            'rotating-coil-analysis=rotcoilanalysis.rotcoilapp:run'
+            'rotating-coil-analysis=rotcoilanalysis.rotcoilapp:run',
+            'rotating-coil-migrate-database='
+            'rotcoilanalysis.migratedatabase:run',
         ],
      },
     zip_safe=False)
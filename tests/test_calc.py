@@ -0,0 +1,134 @@
+"""Tests of the vectorized field calculations against the loop versions."""
+
+import unittest
+
+import numpy as np
+
+from rotcoilanalysis import measurement_data
+
+
+def _get_stack(seed, main_harmonics, nr_harmonics=15, nr_columns=11):
+    rng = np.random.default_rng(seed)
+    stack = rng.normal(size=(len(main_harmonics), nr_harmonics, nr_columns))
+    stack[:, :, 0] = np.arange(1, nr_harmonics + 1)
+    for i, main_harmonic in enumerate(main_harmonics):
+        stack[i, main_harmonic - 1, 1:5] *= 1e4
+    return stack
+
+
+def _integrated_field_loop(multipoles, pos):
+    nr_harmonics = multipoles.shape[0]
+    nrpts = len(pos)
+    int_field_x = np.zeros(nrpts)
+    int_field_y = np.zeros(nrpts)
+    for i in range(nrpts):
+        for n in range(nr_harmonics):
+            int_field_x[i] += multipoles[n, 3]*(pos[i]**n)
+            int_field_y[i] += multipoles[n, 1]*(pos[i]**n)
+    return int_field_x, int_field_y
+
+
+def _residuals_loop(multipoles, main_harmonic, skew_magnet, pos):
+    n = main_harmonic - 1
+    nr_harmonics = multipoles.shape[0]
+    nrpts = len(pos)
+    residual_normal = np.zeros(nrpts)
+    residual_skew = np.zeros(nrpts)
+    residual_mult_normal = np.zeros([nr_harmonics, nrpts])
+    residual_mult_skew = np.zeros([nr_harmonics, nrpts])
+
+    normal = multipoles[:, 1]
+    skew = multipoles[:, 3]
+    if skew_magnet:
+        main_mult = skew[n]
+    else:
+        main_mult = normal[n]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(nrpts):
+            for m in range(n+1, nr_harmonics):
+                residual_normal[i] += (normal[m]/main_mult)*(pos[i]**(m - n))
+                residual_skew[i] += (skew[m]/main_mult)*(pos[i]**(m - n))
+                residual_mult_normal[m, i] = (
+                    normal[m]/main_mult)*(pos[i]**(m - n))
+                residual_mult_skew[m, i] = (
+                    skew[m]/main_mult)*(pos[i]**(m - n))
+
+    return (
+        residual_normal, residual_skew,
+        residual_mult_normal, residual_mult_skew)
+
+
+class CalcIntegratedFieldTest(unittest.TestCase):
+
+    pos = np.linspace(-0.012, 0.012, 25)
+
+    def test_stack(self):
+        stack = _get_stack(0, [1, 2, 3, 2, 3])
+        stack[3, :, :] = 0
+        int_field_x, int_field_y = measurement_data.calc_integrated_field(
+            stack, self.pos)
+        self.assertEqual(int_field_x.shape, (5, len(self.pos)))
+        for i, multipoles in enumerate(stack):
+            expected_x, expected_y = _integrated_field_loop(
+                multipoles, self.pos)
+            np.testing.assert_array_equal(int_field_x[i], expected_x)
+            np.testing.assert_array_equal(int_field_y[i], expected_y)
+
+    def test_single(self):
+        multipoles = _get_stack(1, [2])[0]
+        int_field_x, int_field_y = measurement_data.calc_integrated_field(
+            multipoles, self.pos)
+        expected_x, expected_y = _integrated_field_loop(multipoles, self.pos)
+        np.testing.assert_array_equal(int_field_x, expected_x)
+        np.testing.assert_array_equal(int_field_y, expected_y)
+
+
+class CalcResidualsTest(unittest.TestCase):
+
+    pos = np.linspace(-0.012, 0.012, 25)
+
+    def _check(self, results, multipoles, main_harmonic, skew_magnet):
+        expected = _residuals_loop(
+            multipoles, main_harmonic, skew_magnet, self.pos)
+        for result, value in zip(results, expected):
+            np.testing.assert_array_equal(result, value)
+
+    def test_stack(self):
+        main_harmonics = [1, 2, 3, 1, 2, 3, 2, 3]
+        skew_magnets = [False, False, False, True, True, True, False, True]
+        stack = _get_stack(2, main_harmonics)
+        stack[6, 1, 1] = 0
+        stack[7, 2, 3] = 0
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results = measurement_data.calc_residuals(
+                stack, main_harmonics, skew_magnets, self.pos)
+        self.assertEqual(results[0].shape, (8, len(self.pos)))
+        self.assertEqual(results[2].shape, (8, 15, len(self.pos)))
+        for i in range(len(stack)):
+            self._check(
+                [r[i] for r in results], stack[i], main_harmonics[i],
+                skew_magnets[i])
+
+    def test_broadcast(self):
+        stack = _get_stack(3, [2, 2, 2])
+        for skew_magnet in (False, True):
+            results = measurement_data.calc_residuals(
+                stack, 2, skew_magnet, self.pos)
+            for i in range(len(stack)):
+                self._check(
+                    [r[i] for r in results], stack[i], 2, skew_magnet)
+
+    def test_single(self):
+        for main_harmonic in (1, 2, 3):
+            for skew_magnet in (False, True):
+                multipoles = _get_stack(4, [main_harmonic])[0]
+                results = measurement_data.calc_residuals(
+                    multipoles, main_harmonic, skew_magnet, self.pos)
+                self.assertEqual(results[0].shape, (len(self.pos), ))
+                self._check(results, multipoles, main_harmonic, skew_magnet)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+"""Tests of the database table filters."""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from rotcoilanalysis import database
+from rotcoilanalysis import databasewidgets
+from .utils import write_measurements_database
+
+
+class CompileFilterTest(unittest.TestCase):
+
+    def _compile(self, data_type, filt):
+        return databasewidgets._compile_filter('"c"', data_type, filt)
+
+    def test_parameters(self):
+        column_names = ['id', 'name', 'temperature', 'comments']
+        data_types = [int, str, float, str]
+        filters = ['3~', '', ' >=20.5 ', 'x']
+        conditions, params = databasewidgets.compile_filters(
+            column_names, data_types, filters)
+        self.assertEqual(conditions, [
+            '"id" >= ?', '"temperature" >= ?',
+            '"comments" LIKE ? ESCAPE \'\\\''])
+        self.assertEqual(params, [3, 20.5, '%x%'])
+
+    def test_value_is_not_in_the_condition(self):
+        conditions, params = databasewidgets.compile_filters(
+            ['name'], [str], ["'; DROP TABLE measurements; --"])
+        self.assertNotIn('DROP', conditions[0])
+        self.assertEqual(params, ["%'; DROP TABLE measurements; --%"])
+
+    def test_range(self):
+        self.assertEqual(
+            self._compile(int, '1~5'), ('"c" >= ? AND "c" <= ?', [1, 5]))
+        self.assertEqual(
+            self._compile(float, ' 1.5 ~ 2 '),
+            ('"c" >= ? AND "c" <= ?', [1.5, 2.0]))
+        self.assertEqual(
+            self._compile(str, 'a~b'), ('"c" >= ? AND "c" <= ?', ['a', 'b']))
+
+    def test_open_range(self):
+        self.assertEqual(self._compile(int, '3~'), ('"c" >= ?', [3]))
+        self.assertEqual(self._compile(int, '~3'), ('"c" <= ?', [3]))
+
+    def test_invalid_range(self):
+        for filt in ['~', ' ~ ', '1~2~3']:
+            with self.assertRaises(ValueError):
+                self._compile(int, filt)
+        with self.assertRaises(ValueError):
+            self._compile(int, 'a~b')
+
+    def test_operators(self):
+        for operator in ['<', '<=', '>', '>=', '=', '!=']:
+            self.assertEqual(
+                self._compile(float, operator + '2.5'),
+                ('"c" ' + operator + ' ?', [2.5]))
+            self.assertEqual(
+                self._compile(str, operator + ' Q01'),
+                ('"c" ' + operator + ' ?', ['Q01']))
+
+    def test_numeric_equality(self):
+        self.assertEqual(self._compile(int, '7'), ('"c" = ?', [7]))
+        self.assertEqual(self._compile(float, '7.5'), ('"c" = ?', [7.5]))
+        with self.assertRaises(ValueError):
+            self._compile(float, 'abc')
+
+    def test_prefix(self):
+        self.assertEqual(
+            self._compile(str, 'Q1*'), ('"c" >= ? AND "c" < ?', ['Q1', 'Q2']))
+        self.assertEqual(
+            self._compile(str, 'ab*'), ('"c" >= ? AND "c" < ?', ['ab', 'ac']))
+
+    def test_like_escaping(self):
+        condition, params = self._compile(str, '10%_a\\b')
+        self.assertEqual(condition, '"c" LIKE ? ESCAPE \'\\\'')
+        self.assertEqual(params, ['%10\\%\\_a\\\\b%'])
+
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE t (c TEXT)')
+        values = ['x10%_a\\by', '10%xa\\b', '10x_a\\b', '10%_ab']
+        conn.executemany('INSERT INTO t VALUES (?)', [(v, ) for v in values])
+        rows = conn.execute(
+            'SELECT c FROM t WHERE ' + condition, params).fetchall()
+        conn.close()
+        self.assertEqual(rows, [('x10%_a\\by', )])
+
+    def test_wildcard_inside_text(self):
+        self.assertEqual(
+            self._compile(str, 'a*b'),
+            ('"c" LIKE ? ESCAPE \'\\\'', ['%a*b%']))
+
+    def test_null(self):
+        for filt in ['none', 'NULL', 'None']:
+            self.assertEqual(self._compile(float, filt), ('"c" IS NULL', []))
+            self.assertEqual(self._compile(str, filt), ('"c" IS NULL', []))
+
+
+class TextIndexFilterTest(unittest.TestCase):
+
+    text_index = ('measurements_fts', ['name', 'comments'])
+
+    def _compile(self, column, data_type, filt):
+        return databasewidgets.compile_filters(
+            [column], [data_type], [filt], text_index=self.text_index)
+
+    def test_match(self):
+        self.assertEqual(
+            self._compile('comments', str, ' new "coil" '),
+            (['id IN (SELECT rowid FROM "measurements_fts" '
+              'WHERE "comments" MATCH ?)'],
+             ['"new ""coil"""']))
+
+    def test_filters_without_text_search(self):
+        like = '"comments" LIKE ? ESCAPE \'\\\''
+        self.assertEqual(
+            self._compile('comments', str, 'ab'), ([like], ['%ab%']))
+        self.assertEqual(
+            self._compile('comments', str, 'null'),
+            (['"comments" IS NULL'], []))
+        self.assertEqual(
+            self._compile('comments', str, 'abc*'),
+            (['"comments" >= ? AND "comments" < ?'], ['abc', 'abd']))
+        self.assertEqual(
+            self._compile('comments', str, 'abc~abd'),
+            (['"comments" >= ? AND "comments" <= ?'], ['abc', 'abd']))
+        self.assertEqual(
+            self._compile('comments', str, '!=abc'),
+            (['"comments" != ?'], ['abc']))
+
+    def test_column_not_indexed(self):
+        self.assertEqual(
+            self._compile('magnet_name', str, 'abc'),
+            (['"magnet_name" LIKE ? ESCAPE \'\\\''], ['%abc%']))
+        self.assertEqual(
+            self._compile('name', int, '123'), (['"name" = ?'], [123]))
+
+    def test_query(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'measurements.db')
+            write_measurements_database(filename, 12)
+            try:
+                database.create_text_index(filename)
+            except sqlite3.OperationalError:
+                self.skipTest('SQLite without FTS5 trigram tokenizer.')
+
+            conn = sqlite3.connect(filename)
+            text_index = database.get_text_index(
+                conn.cursor(), 'measurements')
+            self.assertIsNotNone(text_index)
+            ids = []
+            for index in [text_index, None]:
+                conditions, params = databasewidgets.compile_filters(
+                    ['name'], [str], ['Q-1'], text_index=index)
+                ids.append(conn.execute(
+                    'SELECT id FROM measurements WHERE ' + conditions[0] +
+                    ' ORDER BY id', params).fetchall())
+            conn.close()
+        self.assertEqual(ids[0], [(10, ), (11, ), (12, )])
+        self.assertEqual(ids[0], ids[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,275 @@
+"""Tests of the database helpers."""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+
+from rotcoilanalysis import database
+from rotcoilanalysis import measurement_data
+from .utils import write_measurements_database
+
+
+class ArrayBlobTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        for shape in [(0, ), (7, ), (15, 11), (3, 4, 5)]:
+            array = rng.normal(size=shape)
+            for compress in (False, True):
+                blob = database.encode_array(array, compress=compress)
+                decoded = database.decode_array(blob)
+                self.assertEqual(decoded.dtype, np.float64)
+                self.assertEqual(decoded.shape, shape)
+                np.testing.assert_array_equal(decoded, array)
+
+    def test_float32(self):
+        array = np.linspace(-1, 1, 101).reshape(101, 1)
+        blob = database.encode_array(array, dtype=np.float32, compress=True)
+        decoded = database.decode_array(blob)
+        self.assertEqual(decoded.dtype, np.float32)
+        np.testing.assert_array_equal(decoded, array.astype(np.float32))
+
+    def test_byte_order(self):
+        array = np.arange(6, dtype='>f8').reshape(2, 3)
+        blob = database.encode_array(array)
+        self.assertEqual(blob, database.encode_array(array.astype('<f8')))
+        decoded = database.decode_array(memoryview(blob))
+        self.assertTrue(decoded.dtype.isnative)
+        np.testing.assert_array_equal(decoded, array)
+
+    def test_fortran_order(self):
+        array = np.asfortranarray(np.arange(12.0).reshape(3, 4))
+        decoded = database.decode_array(database.encode_array(array))
+        np.testing.assert_array_equal(decoded, array)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            database.encode_array(np.arange(3), dtype=np.int32)
+        blob = database.encode_array(np.arange(3.0))
+        with self.assertRaises(ValueError):
+            database.decode_array(b'XXXX' + blob[4:])
+
+
+class CreateIndexesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.tmp.name, 'measurements.db')
+        write_measurements_database(self.database, 3)
+
+    def tearDown(self):
+        database.close_connections(self.database)
+        self.tmp.cleanup()
+
+    def _get_indexes(self):
+        conn = sqlite3.connect(self.database)
+        indexes = conn.execute(
+            "SELECT tbl_name, name FROM sqlite_master WHERE type='index' "
+            "AND name NOT LIKE 'sqlite_%' ORDER BY name").fetchall()
+        conn.close()
+        return indexes
+
+    def test_create_indexes(self):
+        self.assertTrue(database.create_indexes(self.database))
+        self.assertEqual(self._get_indexes(), [
+            ('measurements', 'measurements_date_idx'),
+            ('measurements', 'measurements_magnet_name_idx'),
+            ('measurements', 'measurements_main_coil_current_avg_idx'),
+            ('measurements', 'measurements_name_idx'),
+            ])
+
+        self.assertTrue(database.create_indexes(self.database))
+        self.assertEqual(len(self._get_indexes()), 4)
+
+    def test_columns(self):
+        self.assertTrue(
+            database.create_indexes(self.database, columns=['id', 'hour']))
+        self.assertEqual(
+            self._get_indexes(), [('measurements', 'measurements_hour_idx')])
+
+    def test_text_index_tables_are_skipped(self):
+        try:
+            database.create_text_index(self.database)
+        except sqlite3.OperationalError:
+            self.skipTest('SQLite without FTS5 trigram tokenizer.')
+
+        self.assertTrue(database.create_indexes(self.database))
+        self.assertEqual(
+            set(table for table, _ in self._get_indexes()), {'measurements'})
+
+    def test_missing_file(self):
+        with self.assertRaises(IOError):
+            database.create_indexes(
+                os.path.join(self.tmp.name, 'missing.db'))
+
+
+class MigrateDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.tmp.name, 'measurements.db')
+        self.values = write_measurements_database(self.database, 4)
+
+    def tearDown(self):
+        database.close_connections(self.database)
+        self.tmp.cleanup()
+
+    def test_migrate(self):
+        conn = sqlite3.connect(self.database)
+        conn.execute(
+            'UPDATE measurements SET read_data = ? WHERE id = 3',
+            ('n\n1 2 bad', ))
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(
+            database.migrate_database(self.database, chunk_size=2), (3, [3]))
+        self.assertEqual(database.migrate_database(self.database), (0, [3]))
+
+        conn = sqlite3.connect(self.database)
+        rows = conn.execute(
+            'SELECT id, multipoles_bin, curves_bin FROM measurements '
+            'ORDER BY id').fetchall()
+        conn.close()
+        for idn, multipoles_bin, curves_bin in rows:
+            if idn == 3:
+                self.assertIsNone(multipoles_bin)
+                self.assertIsNone(curves_bin)
+                continue
+            multipoles, curves = self.values[idn - 1]
+            np.testing.assert_array_equal(
+                database.decode_array(multipoles_bin), multipoles)
+            np.testing.assert_array_equal(
+                database.decode_array(curves_bin), curves)
+
+
+class UpdateDerivedResultsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.tmp.name, 'measurements.db')
+        write_measurements_database(self.database, 5)
+
+    def tearDown(self):
+        database.close_connections(self.database)
+        self.tmp.cleanup()
+
+    def _execute(self, cmd, params=()):
+        conn = sqlite3.connect(self.database)
+        rows = conn.execute(cmd, params).fetchall()
+        conn.commit()
+        conn.close()
+        return rows
+
+    def _get_rows(self):
+        conn = sqlite3.connect(self.database)
+        cur = conn.execute('SELECT * FROM derived_results ORDER BY id')
+        names = [d[0] for d in cur.description]
+        rows = [dict(zip(names, row)) for row in cur.fetchall()]
+        conn.close()
+        return rows
+
+    def test_values(self):
+        self.assertEqual(
+            database.update_derived_results(self.database, chunk_size=2),
+            (5, []))
+
+        rows = self._get_rows()
+        self.assertEqual([row['id'] for row in rows], [1, 2, 3, 4, 5])
+        for row in rows:
+            md = measurement_data.MeasurementData(
+                idn=row['id'], database=self.database, read_curves=False)
+            n = md.main_harmonic - 1
+            main_multipole = md.multipoles[n, 1]
+            r0 = md.normalization_radius
+            self.assertEqual(
+                row['version'], database._derived_results_version)
+            self.assertEqual(row['main_harmonic'], md.main_harmonic)
+            self.assertEqual(row['skew_magnet'], 0)
+            self.assertEqual(row['main_multipole'], main_multipole)
+            self.assertEqual(row['roll'], md.roll)
+            self.assertEqual(row['normalization_radius'], r0)
+            for m in range(database._derived_results_n_harmonics):
+                factor = (r0**(m - n))/main_multipole
+                self.assertAlmostEqual(
+                    row['normal_%d' % (m + 1)],
+                    md.multipoles[m, 1]*factor, delta=1e-12)
+                self.assertAlmostEqual(
+                    row['skew_%d' % (m + 1)],
+                    md.multipoles[m, 3]*factor, delta=1e-12)
+            self.assertEqual(row['normal_%d' % (n + 1)], 1.0)
+
+        self.assertEqual(
+            database.update_derived_results(self.database), (0, []))
+
+    def test_version_refresh(self):
+        database.update_derived_results(self.database)
+        self._execute(
+            'UPDATE derived_results SET version = 0, roll = NULL '
+            'WHERE id IN (2, 4)')
+        self._execute('DELETE FROM derived_results WHERE id = 5')
+
+        self.assertEqual(
+            database.update_derived_results(self.database), (3, []))
+        rows = self._get_rows()
+        self.assertEqual(len(rows), 5)
+        for row in rows:
+            self.assertEqual(
+                row['version'], database._derived_results_version)
+            self.assertIsNotNone(row['roll'])
+
+    def test_unreadable_measurement(self):
+        self._execute(
+            'UPDATE measurements SET read_data = ? WHERE id = 3', ('bad', ))
+
+        self.assertEqual(
+            database.update_derived_results(self.database, chunk_size=2),
+            (5, [3]))
+        row = self._get_rows()[2]
+        self.assertEqual(row['id'], 3)
+        self.assertEqual(row['version'], database._derived_results_version)
+        values = [
+            row[name] for name, _ in database._derived_results_columns]
+        self.assertEqual(values, [None]*len(values))
+        self.assertIsNotNone(self._get_rows()[3]['main_multipole'])
+
+    def test_stop(self):
+        self.assertEqual(
+            database.update_derived_results(
+                self.database, stop=lambda: True), (0, []))
+        self.assertEqual(self._get_rows(), [])
+
+        calls = []
+
+        def stop():
+            calls.append(None)
+            return len(calls) > 2
+
+        self.assertEqual(
+            database.update_derived_results(
+                self.database, chunk_size=2, stop=stop), (4, []))
+        self.assertEqual(
+            [row['id'] for row in self._get_rows()], [1, 2, 3, 4])
+        self.assertEqual(
+            database.update_derived_results(self.database), (1, []))
+
+    def test_create(self):
+        self.assertEqual(
+            database.update_derived_results(self.database, create=False),
+            (0, []))
+        self.assertEqual(
+            self._execute(
+                "SELECT name FROM sqlite_master WHERE type='table' "
+                "AND name = 'derived_results'"), [])
+
+    def test_missing_file(self):
+        with self.assertRaises(IOError):
+            database.update_derived_results(
+                os.path.join(self.tmp.name, 'missing.db'))
+
+
+if __name__ == '__main__':
+    unittest.main()
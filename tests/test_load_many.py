@@ -0,0 +1,128 @@
+"""Tests of the batch measurement loader."""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+
+from rotcoilanalysis import database
+from rotcoilanalysis import measurement_data
+from .utils import write_measurement_file, write_measurements_database
+
+
+class LoadManyFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filenames = []
+        self.values = []
+        for i in range(4):
+            filename = os.path.join(
+                self.tmp.name, 'Q-%02d_Q_180512_10000%d.dat' % (i, i))
+            self.values.append(write_measurement_file(filename, seed=i))
+            self.filenames.append(filename)
+
+        self.bad_filename = os.path.join(
+            self.tmp.name, 'Q-99_Q_180512_100009.dat')
+        open(self.bad_filename, 'w').close()
+        self.filenames.insert(2, self.bad_filename)
+        self.values.insert(2, None)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _check(self, data, errors):
+        self.assertEqual(len(data), len(self.filenames))
+        self.assertEqual(len(errors), len(self.filenames))
+        for md, error, filename, values in zip(
+                data, errors, self.filenames, self.values):
+            if values is None:
+                self.assertIsNone(md)
+                self.assertIsInstance(
+                    error, measurement_data.MeasurementDataError)
+            else:
+                self.assertIsNone(error)
+                self.assertEqual(md.filename, filename)
+                np.testing.assert_array_equal(md.multipoles, values[0])
+                np.testing.assert_array_equal(md.curves, values[1])
+
+    def test_missing_and_corrupt_files(self):
+        missing_filename = os.path.join(
+            self.tmp.name, 'Q-98_Q_180512_100008.dat')
+        corrupt_filename = os.path.join(
+            self.tmp.name, 'Q-97_Q_180512_100007.dat')
+        with open(self.filenames[0], encoding='latin1') as f:
+            text = f.read()
+        lines = text.split('\n')
+        index = lines.index('##Reading Data (multipoles)') + 3
+        lines[index] = lines[index] + '\tnot_a_number'
+        with open(corrupt_filename, 'w', encoding='latin1') as f:
+            f.write('\n'.join(lines))
+
+        self.filenames[1:1] = [missing_filename, corrupt_filename]
+        self.values[1:1] = [None, None]
+        self._check(*measurement_data.load_many(self.filenames))
+        self._check(*measurement_data.load_many(self.filenames, workers=2))
+
+    def test_serial(self):
+        self._check(*measurement_data.load_many(self.filenames))
+
+    def test_process_pool(self):
+        self._check(*measurement_data.load_many(self.filenames, workers=2))
+
+    def test_cache(self):
+        cache = measurement_data.MeasurementDataCache(
+            os.path.join(self.tmp.name, 'cache'))
+        self._check(*measurement_data.load_many(
+            self.filenames, cache=cache, workers=2))
+        self._check(*measurement_data.load_many(
+            self.filenames, read_curves=False, cache=cache))
+
+
+class LoadManyDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.tmp.name, 'measurements.db')
+        self.values = write_measurements_database(self.database, 6)
+
+        conn = sqlite3.connect(self.database)
+        conn.execute(
+            'UPDATE measurements SET read_data = ? WHERE id = 4', ('bad', ))
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        database.close_connections(self.database)
+        self.tmp.cleanup()
+
+    def _check(self, idns, data, errors):
+        self.assertEqual(len(data), len(idns))
+        self.assertEqual(len(errors), len(idns))
+        for idn, md, error in zip(idns, data, errors):
+            if idn in (4, 10):
+                self.assertIsNone(md)
+                self.assertIsInstance(
+                    error, measurement_data.MeasurementDataError)
+            else:
+                self.assertIsNone(error)
+                self.assertEqual(md.idn, idn)
+                multipoles, curves = self.values[idn - 1]
+                np.testing.assert_array_equal(md.multipoles, multipoles)
+                np.testing.assert_array_equal(md.curves, curves)
+
+    def test_bad_rows_are_reported_per_item(self):
+        idns = [6, 4, 1, 10, 2, 3]
+        self._check(idns, *measurement_data.load_many(
+            idns, database=self.database))
+
+    def test_process_pool(self):
+        idns = [5, 4, 1, 10, 2, 3, 6]
+        self._check(idns, *measurement_data.load_many(
+            idns, database=self.database, workers=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""Tests of the persistent cache of parsed measurement files."""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from rotcoilanalysis import measurement_data
+from .utils import write_measurement_file
+
+
+class MeasurementDataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+        self.filename = os.path.join(
+            self.tmp.name, 'Q-01_Q_180512_100000.dat')
+        self.multipoles, self.curves = write_measurement_file(self.filename)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _new_data(self, cache, **kwargs):
+        md = measurement_data.MeasurementData.__new__(
+            measurement_data.MeasurementData)
+        md._init_attributes(
+            self.filename, None, None, kwargs.get('read_curves', False),
+            cache, False, kwargs.get('curves_dtype', np.float64))
+        return md
+
+    def test_round_trip(self):
+        cache = measurement_data.MeasurementDataCache(self.cache_dir)
+        md = measurement_data.MeasurementData(self.filename, cache=cache)
+
+        cached = self._new_data(cache)
+        self.assertTrue(cache.load(cached))
+        self.assertEqual(cached.magnet_name, md.magnet_name)
+        self.assertEqual(cached.main_harmonic, md.main_harmonic)
+        np.testing.assert_array_equal(cached.multipoles, self.multipoles)
+        self.assertTrue(cache.load_curves(cached))
+        np.testing.assert_array_equal(cached.curves, self.curves)
+
+    def test_header_only_load_skips_curves(self):
+        cache = measurement_data.MeasurementDataCache(self.cache_dir)
+        md = measurement_data.MeasurementData(
+            self.filename, read_curves=False, cache=cache)
+        np.testing.assert_array_equal(md.curves, self.curves)
+
+        md = measurement_data.MeasurementData(
+            self.filename, read_curves=False, cache=cache)
+        self.assertIsNone(md._curves)
+        np.testing.assert_array_equal(md.curves, self.curves)
+
+    def test_modified_file_is_not_served(self):
+        cache = measurement_data.MeasurementDataCache(self.cache_dir)
+        measurement_data.MeasurementData(self.filename, cache=cache)
+
+        multipoles, _ = write_measurement_file(
+            self.filename, main_current=200.25, seed=1)
+        st = os.stat(self.filename)
+        os.utime(self.filename, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertFalse(cache.load(self._new_data(cache)))
+
+        md = measurement_data.MeasurementData(self.filename, cache=cache)
+        self.assertEqual(md.main_coil_current_avg, 200.25)
+        np.testing.assert_array_equal(md.multipoles, multipoles)
+
+    def test_curves_precision(self):
+        cache = measurement_data.MeasurementDataCache(self.cache_dir)
+        measurement_data.MeasurementData(
+            self.filename, cache=cache, curves_dtype=np.float32)
+
+        self.assertFalse(cache.load_curves(self._new_data(cache)))
+        md = measurement_data.MeasurementData(self.filename, cache=cache)
+        self.assertEqual(md.curves.dtype, np.float64)
+        np.testing.assert_array_equal(md.curves, self.curves)
+
+        md = self._new_data(cache, curves_dtype=np.float32)
+        self.assertTrue(cache.load_curves(md))
+        self.assertEqual(md.curves.dtype, np.float32)
+        np.testing.assert_array_equal(
+            md.curves, self.curves.astype(np.float32))
+
+    def test_least_recently_used_entries_are_removed(self):
+        filenames = [self.filename]
+        for i in range(1, 4):
+            filename = os.path.join(
+                self.tmp.name, 'Q-0%d_Q_180512_10000%d.dat' % (i + 1, i))
+            write_measurement_file(filename, seed=i)
+            filenames.append(filename)
+
+        cache = measurement_data.MeasurementDataCache(self.cache_dir)
+        for i, filename in enumerate(filenames[:3]):
+            measurement_data.MeasurementData(filename, cache=cache)
+            path = cache._get_entry_path(filename)
+            os.utime(path, (1000 + i, 1000 + i))
+
+        md = self._new_data(cache)
+        md._filename = filenames[0]
+        self.assertTrue(cache.load(md))
+
+        entry_size = os.path.getsize(cache._get_entry_path(filenames[0]))
+        cache.max_size = 3.9*entry_size
+        measurement_data.MeasurementData(filenames[3], cache=cache)
+
+        exists = [
+            os.path.isfile(cache._get_entry_path(f)) for f in filenames]
+        self.assertEqual(exists, [True, False, True, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
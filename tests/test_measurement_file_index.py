@@ -0,0 +1,92 @@
+"""Tests of the persistent index of measurement file directories."""
+
+import os
+import tempfile
+import unittest
+
+from rotcoilanalysis import measurement_data
+from .utils import write_measurement_file
+
+
+class MeasurementFileIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp.name, 'data')
+        self.index_directory = os.path.join(self.tmp.name, 'index')
+        os.makedirs(self.directory)
+
+        self.filenames = [
+            'Q-02_Q_180512_090000.dat',
+            'Q-01_Q_180511_230000.dat',
+            'Q-03_Q_180512_100000.dat',
+            ]
+        for i, filename in enumerate(self.filenames):
+            write_measurement_file(
+                os.path.join(self.directory, filename), main_current=i)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _new_index(self):
+        return measurement_data.MeasurementFileIndex(
+            self.directory, self.index_directory)
+
+    def test_files_are_sorted_by_timestamp(self):
+        index = self._new_index()
+        self.assertTrue(index.update())
+        self.assertEqual(index.filenames, [
+            'Q-01_Q_180511_230000.dat',
+            'Q-02_Q_180512_090000.dat',
+            'Q-03_Q_180512_100000.dat',
+            ])
+        summary = index.get_summary('Q-03_Q_180512_100000.dat')
+        self.assertEqual(summary['main_coil_current_avg'], 2)
+        self.assertEqual(summary['date'], '12/05/2018')
+
+    def test_saved_index_is_loaded(self):
+        index = self._new_index()
+        index.update()
+
+        index = self._new_index()
+        self.assertEqual(len(index.filenames), 3)
+        self.assertFalse(index.update())
+
+    def test_new_and_removed_files(self):
+        index = self._new_index()
+        index.update()
+
+        os.remove(os.path.join(self.directory, self.filenames[0]))
+        write_measurement_file(
+            os.path.join(self.directory, 'Q-00_Q_180510_080000.dat'))
+        self.assertTrue(index.update())
+        self.assertEqual(index.filenames, [
+            'Q-00_Q_180510_080000.dat',
+            'Q-01_Q_180511_230000.dat',
+            'Q-03_Q_180512_100000.dat',
+            ])
+
+    def test_file_rewritten_in_place(self):
+        index = self._new_index()
+        index.update()
+
+        filepath = os.path.join(self.directory, self.filenames[2])
+        dir_st = os.stat(self.directory)
+        write_measurement_file(filepath, main_current=12.5)
+        st = os.stat(filepath)
+        os.utime(filepath, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        os.utime(
+            self.directory, ns=(dir_st.st_atime_ns, dir_st.st_mtime_ns))
+
+        self.assertTrue(index.update())
+        summary = index.get_summary(self.filenames[2])
+        self.assertEqual(summary['main_coil_current_avg'], 12.5)
+
+        index = self._new_index()
+        self.assertFalse(index.update())
+        summary = index.get_summary(self.filenames[2])
+        self.assertEqual(summary['main_coil_current_avg'], 12.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
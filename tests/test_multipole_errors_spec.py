@@ -0,0 +1,133 @@
+"""Tests of the multipole errors specification limits."""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from rotcoilanalysis import multipole_errors_spec
+from rotcoilanalysis import rotcoilwindow
+
+
+def _value(i):
+    return (np.full(3, i, dtype=float), np.zeros(3), np.ones(3))
+
+
+class SpecEnvelopeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_least_recently_used_entry_is_removed(self):
+        cache = multipole_errors_spec.SpecEnvelopeCache(max_entries=2)
+        cache.set(('a', ), _value(1))
+        cache.set(('b', ), _value(2))
+        self.assertIsNotNone(cache.get(('a', )))
+        cache.set(('c', ), _value(3))
+
+        self.assertIsNone(cache.get(('b', )))
+        np.testing.assert_array_equal(cache.get(('a', ))[0], _value(1)[0])
+        np.testing.assert_array_equal(cache.get(('c', ))[0], _value(3)[0])
+
+    def test_entries_are_saved(self):
+        directory = os.path.join(self.tmp.name, 'spec')
+        cache = multipole_errors_spec.SpecEnvelopeCache(directory=directory)
+        cache.set(('a', 0.012, 'normal'), _value(1))
+
+        cache = multipole_errors_spec.SpecEnvelopeCache(directory=directory)
+        value = cache.get(('a', 0.012, 'normal'))
+        for array, expected in zip(value, _value(1)):
+            np.testing.assert_array_equal(array, expected)
+        self.assertIsNone(cache.get(('a', 0.012, 'skew')))
+
+        cache.clear()
+        cache = multipole_errors_spec.SpecEnvelopeCache(directory=directory)
+        self.assertIsNone(cache.get(('a', 0.012, 'normal')))
+
+    def test_saved_entries_are_removed(self):
+        directory = os.path.join(self.tmp.name, 'spec')
+        cache = multipole_errors_spec.SpecEnvelopeCache(
+            max_entries=2, directory=directory)
+        for i, key in enumerate(['a', 'b']):
+            cache.set((key, ), _value(i))
+            path = cache._get_entry_path((key, ))
+            os.utime(path, (1000 + i, 1000 + i))
+        cache.set(('c', ), _value(2))
+
+        cache = multipole_errors_spec.SpecEnvelopeCache(
+            max_entries=2, directory=directory)
+        self.assertIsNone(cache.get(('a', )))
+        self.assertIsNotNone(cache.get(('b', )))
+        self.assertIsNotNone(cache.get(('c', )))
+
+
+class ResidualFieldCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = multipole_errors_spec.SpecEnvelopeCache()
+        multipole_errors_spec.set_envelope_cache(self.cache)
+        self.x = np.linspace(-0.012, 0.012, 25)
+
+    def tearDown(self):
+        multipole_errors_spec.set_envelope_cache(
+            multipole_errors_spec.SpecEnvelopeCache())
+
+    def test_seeded_limits_are_cached(self):
+        limits = multipole_errors_spec.normal_residual_field(
+            0.0175, self.x, 'DPM', seed=1)
+        self.assertEqual(len(self.cache._entries), 1)
+
+        limits[1][:] = 0
+        cached = multipole_errors_spec.normal_residual_field(
+            0.0175, self.x, 'DPM', seed=1)
+        self.assertEqual(len(self.cache._entries), 1)
+
+        multipole_errors_spec.set_envelope_cache(None)
+        expected = multipole_errors_spec.normal_residual_field(
+            0.0175, self.x, 'DPM', seed=1)
+        for array, expected_array in zip(cached, expected):
+            np.testing.assert_array_equal(array, expected_array)
+
+    def test_cache_keys(self):
+        multipole_errors_spec.normal_residual_field(
+            0.0175, self.x, 'DPM', seed=1)
+        multipole_errors_spec.normal_residual_field(
+            0.0175, self.x, 'DPM', seed=2)
+        multipole_errors_spec.skew_residual_field(
+            0.0175, self.x, 'DPM', seed=1)
+        multipole_errors_spec.normal_residual_field(
+            0.0175, self.x[:-1], 'DPM', seed=1)
+        multipole_errors_spec.normal_residual_field(
+            0.0175, self.x, 'DPM', mode='analytic')
+        multipole_errors_spec.normal_residual_field(
+            0.0175, self.x, 'DPM', seed=3, mode='analytic')
+        self.assertEqual(len(self.cache._entries), 5)
+
+    def test_window_limits_are_cached(self):
+        residual_field = mock.Mock(
+            wraps=multipole_errors_spec._residual_field)
+        with mock.patch.object(
+                multipole_errors_spec, '_residual_field', residual_field):
+            for i in range(3):
+                for function in (
+                        multipole_errors_spec.normal_residual_field,
+                        multipole_errors_spec.skew_residual_field):
+                    function(
+                        0.0175, self.x, 'DPM', seed=rotcoilwindow._spec_seed,
+                        mode='sampled')
+        self.assertEqual(residual_field.call_count, 2)
+        self.assertEqual(len(self.cache._entries), 2)
+
+    def test_unseeded_limits_are_not_cached(self):
+        multipole_errors_spec.normal_residual_field(0.0175, self.x, 'DPM')
+        multipole_errors_spec.skew_residual_field(0.0175, self.x, 'DPM')
+        self.assertEqual(len(self.cache._entries), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
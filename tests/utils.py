@@ -0,0 +1,134 @@
+"""Helpers to write small measurement files for the tests."""
+
+import sqlite3 as _sqlite3
+import contextlib as _contextlib
+import numpy as _np
+
+
+_header = [
+    ('date', '12/05/2018'),
+    ('hour', '10:00:00'),
+    ('operator', 'operator'),
+    ('software_version', '1.0'),
+    ('bench', '1'),
+    ('temperature_magnet', '23.4'),
+    ('rotation_motor_speed', '1.0'),
+    ('rotation_motor_acceleration', '2.0'),
+    ('coil_rotation_direction', 'A'),
+    ('integrator_gain', '10'),
+    ('n_integration_points', '16'),
+    ('n_turns', '4'),
+    ('n_collections', '1'),
+    ('analysis_interval', '1-4'),
+    ('main_coil_current_avg', '100.5'),
+    ('main_coil_current_std', '0.01'),
+    ('measurement_type', 'M1'),
+    ('comments', 'test'),
+    ('rotating_coil_name', 'coil'),
+    ('rotating_coil_type', 'radial'),
+    ('n_turns_main_coil', '10'),
+    ('main_coil_internal_radius', '0.01'),
+    ('main_coil_external_radius', '0.02'),
+    ]
+
+
+def _get_values(seed, npoints, ncurves):
+    rng = _np.random.default_rng(seed)
+    multipoles = rng.normal(scale=1e-3, size=(15, 11))
+    multipoles[:, 0] = _np.arange(1, 16)
+    multipoles[:, 7] = 0
+    multipoles[1, 1] = 10
+    multipoles[1, 7] = 1e-3
+    curves = rng.normal(scale=1e3, size=(npoints, ncurves))
+    return multipoles, curves
+
+
+def _get_read_data_lines(multipoles):
+    lines = [
+        'n\tNnMagnet\tNormal\tNormalErr\tSkew\tSkewErr\tNnorm\tSnorm\t'
+        'Angle\tAngleErr\tr@12mm']
+    for row in multipoles:
+        lines.append('\t'.join(
+            ['%d' % row[0]] + ['%.12e' % v for v in row[1:]]))
+    return lines
+
+
+def _get_raw_curve_lines(curves):
+    lines = []
+    for i, row in enumerate(curves):
+        lines.append('\t'.join(['%d' % (i + 1)] + ['%.6e' % v for v in row]))
+    return lines
+
+
+def _round_values(multipoles, curves):
+    multipoles = _np.array(
+        [float('%.12e' % v) for v in multipoles.ravel()]).reshape(
+            multipoles.shape)
+    curves = _np.array(
+        [float('%.6e' % v) for v in curves.ravel()]).reshape(curves.shape)
+    return multipoles, curves
+
+
+def write_measurement_file(
+        filename, main_current=100.5, seed=0, npoints=16, ncurves=4):
+    """Write a quadrupole measurement file.
+
+    Returns:
+        tuple (multipoles, curves) with the values written to the file.
+    """
+    multipoles, curves = _get_values(seed, npoints, ncurves)
+
+    lines = ['file\tC:\\data\\' + filename.replace('\\', '/').split('/')[-1]]
+    for key, value in _header:
+        if key == 'main_coil_current_avg':
+            value = str(main_current)
+        lines.append('{0:s}\t{1:s}'.format(key, value))
+
+    lines.append('')
+    lines.append('##Reading Data (multipoles)')
+    lines.extend(_get_read_data_lines(multipoles))
+
+    lines.append('')
+    lines.append('##Raw Data Stored')
+    lines.append('start')
+    lines.append('end')
+    lines.append('\t'.join(['pt'] + ['T%d' % i for i in range(ncurves)]))
+    lines.extend(_get_raw_curve_lines(curves))
+
+    with open(filename, 'w', encoding='latin1') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    return _round_values(multipoles, curves)
+
+
+def write_measurements_database(database, nr_rows, npoints=16, ncurves=4):
+    """Write a database with a measurements table.
+
+    The row with ID i is written with seed i.
+
+    Returns:
+        list of tuples (multipoles, curves) with the values of each row.
+    """
+    values = []
+    with _contextlib.closing(_sqlite3.connect(database)) as conn:
+        conn.execute(
+            'CREATE TABLE measurements (id INTEGER PRIMARY KEY '
+            'AUTOINCREMENT, name TEXT, date TEXT, hour TEXT, filename TEXT, '
+            'magnet_name TEXT, magnet_model INTEGER, '
+            'main_coil_current_avg REAL, analisys_interval TEXT, '
+            'comments TEXT, operator TEXT, normalization_radius REAL, '
+            'read_data TEXT, raw_curve TEXT)')
+        for idn in range(1, nr_rows + 1):
+            multipoles, curves = _get_values(idn, npoints, ncurves)
+            read_data = '\n'.join(_get_read_data_lines(multipoles))
+            raw_curve = '\n'.join(
+                ['start', 'end'] + _get_raw_curve_lines(curves))
+            conn.execute(
+                'INSERT INTO measurements VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (idn, 'Q-%02d' % idn, '12/05/2018', '10:00:%02d' % idn,
+                 'Q-%02d.dat' % idn, 'Q-%02d' % idn, 2, 100.0 + idn, '1-4',
+                 'test', 'operator', 0.012, read_data, raw_curve))
+            values.append(_round_values(multipoles, curves))
+        conn.commit()
+    return values